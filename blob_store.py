@@ -0,0 +1,165 @@
+import hashlib
+import os
+import tempfile
+import time
+from pathlib import Path
+from uuid import UUID
+
+
+class BlobStore():
+    """Content-addressed storage for content of file-like messages.
+
+    Blob is named after SHA-256 of its content and first 16 bytes of
+    the hash are its download id, so a file that is sent several times
+    (e.g. to different chatrooms) is stored only once.
+    Blobs are sharded into ```root/ab/cd/``` directories by the first
+    bytes of the hash to keep directories small.
+    """
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        # Temporary files are kept on the same filesystem,
+        # so they can be moved in place atomically
+        self._tmp = root / "tmp"
+        self._tmp.mkdir(parents=True, exist_ok=True)
+        # Partially uploaded files
+        self._uploads = root / "uploads"
+        self._uploads.mkdir(parents=True, exist_ok=True)
+
+    def path(self, download_id: UUID) -> Path:
+        h = download_id.hex
+        return self.root / h[:2] / h[2:4] / h
+
+    def exists(self, download_id: UUID) -> bool:
+        return self.path(download_id).exists()
+
+    def sink(self) -> "BlobSink":
+        return BlobSink(self)
+
+    def put(self, data: bytes) -> UUID:
+        sink = self.sink()
+        sink.write(data)
+        sink.close()
+        return sink.download_id
+
+    def get(self, download_id: UUID) -> bytes:
+        """:raises FileNotFoundError: if there is no such blob."""
+        with open(self.path(download_id), "rb") as f:
+            return f.read()
+
+    def get_preview(self, download_id: UUID) -> bytes | None:
+        """Returns preview of a blob if it was made before."""
+        try:
+            return self._preview_path(download_id).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def put_preview(self, download_id: UUID, data: bytes) -> None:
+        """Saves preview of a blob, so it is made only once."""
+        fd, tmp = tempfile.mkstemp(dir=self._tmp)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        path = self._preview_path(download_id)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp, path)
+
+    def upload_offset(self, owner: str, upload_id: UUID) -> int:
+        """Returns how many bytes of an upload are stored."""
+        try:
+            return self._upload_path(owner, upload_id).stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    def append(self, owner: str, upload_id: UUID,
+               offset: int, data: bytes) -> int:
+        """Appends ```data``` to an upload if it starts right where
+        stored part ends, otherwise the chunk is ignored.
+
+        :return: bytes of the upload stored
+        :rtype: ```int```
+        """
+        with open(self._upload_path(owner, upload_id), "ab") as f:
+            size = f.tell()
+            if size != offset:
+                return size
+            f.write(data)
+            return size + len(data)
+
+    def finish_upload(self, owner: str, upload_id: UUID, size: int) -> UUID:
+        """Moves complete upload into the store.
+
+        :raises FileNotFoundError: if there is no such upload.
+        :raises ValueError: if upload is not ```size``` bytes long.
+        :return: download id of the blob
+        :rtype: ```UUID```
+        """
+        path = self._upload_path(owner, upload_id)
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size != size:
+                raise ValueError("Upload is incomplete")
+            while chunk := f.read(1 << 20):
+                h.update(chunk)
+            os.fsync(f.fileno())
+        download_id = UUID(bytes=h.digest()[:16])
+        self._commit(str(path), download_id)
+        return download_id
+
+    def remove_stale_uploads(self, max_age: float) -> None:
+        """Removes uploads which were not appended to for ```max_age```
+        seconds."""
+        deadline = time.time() - max_age
+        for path in self._uploads.iterdir():
+            try:
+                if path.stat().st_mtime < deadline:
+                    path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def _upload_path(self, owner: str, upload_id: UUID) -> Path:
+        # Upload ids are chosen by clients, so they are
+        # namespaced by the user to not collide
+        key = hashlib.sha256(owner.encode() + upload_id.bytes).hexdigest()
+        return self._uploads / key
+
+    def _preview_path(self, download_id: UUID) -> Path:
+        return self.path(download_id).with_suffix(".preview")
+
+    def _commit(self, tmp: str, download_id: UUID) -> None:
+        path = self.path(download_id)
+        if path.exists():
+            os.remove(tmp)
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Concurrent writers of the same blob replace it with the same content
+        os.replace(tmp, path)
+
+
+class BlobSink():
+    """```MessageSink``` that writes content into a temporary file,
+    hashing it on the way, and moves the file in place under its hash
+    only after the message is authenticated. Its methods do blocking
+    I/O, so ```AsyncReceiver``` calls them in a thread."""
+    def __init__(self, store: BlobStore) -> None:
+        self.store = store
+        fd, self._tmp = tempfile.mkstemp(dir=store._tmp)
+        self._f = os.fdopen(fd, "wb")
+        self._hash = hashlib.sha256()
+        # Known only after the whole content is written
+        self.download_id = UUID(int=0)
+
+    def write(self, data: bytes) -> None:
+        self._f.write(data)
+        self._hash.update(data)
+
+    def close(self) -> None:
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._f.close()
+        self.download_id = UUID(bytes=self._hash.digest()[:16])
+        self.store._commit(self._tmp, self.download_id)
+
+    def abort(self) -> None:
+        if self._f.closed:
+            return
+        self._f.close()
+        os.remove(self._tmp)
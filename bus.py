@@ -0,0 +1,192 @@
+import asyncio
+from asyncio import IncompleteReadError
+from asyncio.streams import StreamReader, StreamWriter
+import itertools
+import os
+import pickle
+import socket
+from typing import Any, Awaitable, Callable
+
+
+# Events are dicts with "event" key:
+#   online  - user signed in on a worker ("user", "code" - friend code)
+#   offline - user disconnected ("user")
+#   code    - user's friend code has changed ("user", "code")
+#   message - message to relay ("user" - sender, "tags", "data")
+# and requests which only the Broker handles:
+#   claim   - worker wants to sign in a user ("user", "id"), Broker
+#             replies with "claimed" ("id", "ok") to that worker only
+#   release - user that was claimed hasn't signed in ("user")
+Event = dict[str, Any]
+
+def _frame(event: Event) -> bytes:
+    data = pickle.dumps(event)
+    return len(data).to_bytes(4, "big") + data
+
+async def _read_event(reader: StreamReader) -> Event:
+    length = int.from_bytes(await reader.readexactly(4), "big")
+    return pickle.loads(await reader.readexactly(length))
+
+def bind(path: str) -> socket.socket:
+    """Creates listening socket of the bus before workers are forked,
+    so they can connect right away. Only owner can connect to it."""
+    if os.path.exists(path):
+        os.remove(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Socket file is created with owner-only permissions, events are
+    # pickled so nobody else may connect even for a moment
+    umask = os.umask(0o177)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(umask)
+    sock.listen()
+    return sock
+
+
+class Broker():
+    """Forwards every event from one worker to all the others.
+
+    Broker keeps presence of users, so a worker that (re)connects
+    gets a snapshot of who is online on other workers. Users are signed
+    in only after a worker claims them, so the same user can't sign in
+    on two workers at once.
+    """
+    def __init__(self, sock: socket.socket) -> None:
+        self.sock = sock
+        self._workers: set[StreamWriter] = set()
+        # Username -> "online" event of a user and writer of its worker
+        self._presence: dict[str, tuple[Event, StreamWriter]] = {}
+        # Username -> writer of the worker which is signing the user in
+        self._claims: dict[str, StreamWriter] = {}
+
+    async def serve(self) -> None:
+        server = await asyncio.start_unix_server(self._handle, sock=self.sock)
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader: StreamReader, writer: StreamWriter) -> None:
+        for event, _ in self._presence.values():
+            writer.write(_frame(event))
+        self._workers.add(writer)
+
+        try:
+            while True:
+                event = await _read_event(reader)
+                if event["event"] in ("claim", "release"):
+                    self._claim(event, writer)
+                    continue
+                self._track(event, writer)
+                await self._publish(event, writer)
+        except (IncompleteReadError, ConnectionError):
+            # Worker has died, so have its users' connections
+            self._workers.discard(writer)
+            for user in [u for u, w in self._claims.items() if w is writer]:
+                del self._claims[user]
+            gone = [u for u, (_, w) in self._presence.items() if w is writer]
+            for user in gone:
+                del self._presence[user]
+                await self._publish({"event": "offline", "user": user}, writer)
+            writer.close()
+
+    def _claim(self, event: Event, writer: StreamWriter) -> None:
+        user = event["user"]
+        if event["event"] == "release":
+            if self._claims.get(user) is writer:
+                del self._claims[user]
+            return
+        ok = user not in self._presence and user not in self._claims
+        if ok:
+            self._claims[user] = writer
+        writer.write(_frame({"event": "claimed", "id": event["id"], "ok": ok}))
+
+    def _track(self, event: Event, writer: StreamWriter) -> None:
+        match event["event"]:
+            case "online":
+                self._claims.pop(event["user"], None)
+                self._presence[event["user"]] = (event, writer)
+            case "offline":
+                self._presence.pop(event["user"], None)
+            case "code" if event["user"] in self._presence:
+                online, w = self._presence[event["user"]]
+                self._presence[event["user"]] = (
+                        {**online, "code": event["code"]}, w
+                        )
+
+    async def _publish(self, event: Event, origin: StreamWriter) -> None:
+        data = _frame(event)
+        for w in list(self._workers):
+            if w is not origin:
+                w.write(data)
+        for w in list(self._workers):
+            if w is not origin:
+                try:
+                    await w.drain()
+                except ConnectionError:
+                    self._workers.discard(w)
+
+
+class BusClient():
+    """Connection of a worker process to the ```Broker```."""
+    def __init__(
+            self, path: str, handler: Callable[[Event], Awaitable[None]]
+    ) -> None:
+        self.path = path
+        self.handler = handler
+        # Claims waiting for the Broker's reply by their ids
+        self._claims: dict[int, asyncio.Future[bool]] = {}
+        self._ids = itertools.count()
+        self.closed = False
+
+    async def connect(self) -> None:
+        reader, self._writer = await asyncio.open_unix_connection(self.path)
+        self._task = asyncio.create_task(self._listen(reader))
+
+    async def publish(self, event: Event) -> None:
+        # Whole event is written at once, so events
+        # from different coroutines don't interleave
+        self._writer.write(_frame(event))
+        await self._writer.drain()
+
+    async def claim(self, user: str) -> bool:
+        """Asks the Broker to let this worker sign in ```user```.
+        Claim lasts until the user goes online or is released.
+
+        :return: ```False``` if the user is online or is signing in
+                 on another worker. Without the Broker every claim
+                 succeeds, so only local checks remain.
+        :rtype: ```bool```
+        """
+        if self.closed:
+            return True
+        claim_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._claims[claim_id] = future
+        try:
+            await self.publish({"event": "claim", "user": user, "id": claim_id})
+            return await future
+        finally:
+            del self._claims[claim_id]
+
+    async def release(self, user: str) -> None:
+        """Drops claim of a user who failed to sign in."""
+        if not self.closed:
+            await self.publish({"event": "release", "user": user})
+
+    async def _listen(self, reader: StreamReader) -> None:
+        while True:
+            try:
+                event = await _read_event(reader)
+            except IncompleteReadError:
+                print("[-] Message bus is closed.")
+                break
+            if event["event"] == "claimed":
+                future = self._claims.get(event["id"])
+                if future is not None and not future.done():
+                    future.set_result(event["ok"])
+                continue
+            await self.handler(event)
+        self.closed = True
+        for future in self._claims.values():
+            if not future.done():
+                future.set_result(True)
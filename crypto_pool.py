@@ -0,0 +1,105 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from Crypto.Cipher import PKCS1_OAEP
+from Crypto.Cipher.PKCS1_OAEP import PKCS1OAEP_Cipher
+from Crypto.PublicKey import RSA
+
+from gui.widgets.utils.encryption import (
+    encrypt_aes, decrypt_aes, pack_data, unpack_data,
+)
+from gui.widgets.message import HeaderParser, Tags
+
+
+# Server's private RSA cipher of the current process
+_cipher: PKCS1OAEP_Cipher | None = None
+
+def init_worker(private_key: bytes) -> None:
+    global _cipher
+    _cipher = PKCS1_OAEP.new(RSA.import_key(private_key))
+
+def rsa_decrypt(data: bytes) -> bytes:
+    return _cipher.decrypt(data) #type: ignore
+
+def parse_header(header: bytes) -> Tags:
+    return HeaderParser(header, _cipher).tags #type: ignore
+
+def open_packed(data: bytes) -> bytes:
+    """Decrypts output of ```pack_data``` addressed to the server."""
+    text, aes, _ = unpack_data(data)
+    return decrypt_aes(text, _cipher.decrypt(aes)) #type: ignore
+
+def seal(msg: bytes, public_key: bytes) -> bytes:
+    return pack_data(encrypt_aes(msg), public_key)
+
+
+class CryptoPool():
+    """Runs RSA operations of the server in a pool of processes,
+    so they are not serialized by the GIL and don't block the event loop.
+
+    Workers are forked with the server's private key, thus pool
+    is available only where ```fork``` is. With ```workers``` set to 0
+    or without ```fork``` everything runs in the calling thread.
+    If a worker dies, the pool is made again.
+    """
+    def __init__(self, private_key: bytes, workers: int) -> None:
+        init_worker(private_key)
+        self.private_key = private_key
+        self.workers = workers
+
+        self._executor = None
+        if workers > 0 and "fork" in multiprocessing.get_all_start_methods():
+            self._executor = self._new_executor()
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=init_worker,
+                initargs=(self.private_key,),
+                )
+
+    def start(self) -> None:
+        """Forks all workers. Should be called before any other
+        threads are started as forking a multithreaded process is unsafe."""
+        if self._executor is not None:
+            self._executor.submit(int).result()
+
+    async def run(self, func, *args):
+        if self._executor is None:
+            return func(*args)
+        loop = asyncio.get_running_loop()
+        executor = self._executor
+        try:
+            return await loop.run_in_executor(executor, func, *args)
+        except BrokenProcessPool:
+            # Worker has died (e.g. killed for lack of memory),
+            # which leaves the whole pool unusable
+            self._restart(executor)
+            return await loop.run_in_executor(self._executor, func, *args)
+
+    def _restart(self, broken: ProcessPoolExecutor) -> None:
+        # Calls that failed together restart the pool only once
+        if self._executor is not broken:
+            return
+        print("[-] Crypto worker has died, restarting the pool.")
+        broken.shutdown(wait=False, cancel_futures=True)
+        self._executor = self._new_executor()
+
+    async def rsa_decrypt(self, data: bytes) -> bytes:
+        return await self.run(rsa_decrypt, bytes(data))
+
+    async def parse_header(self, header: bytes) -> Tags:
+        return await self.run(parse_header, header)
+
+    async def open_packed(self, data: bytes) -> bytes:
+        return await self.run(open_packed, data)
+
+    async def seal(self, msg: bytes, public_key: bytes) -> bytes:
+        return await self.run(seal, msg, public_key)
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
@@ -1,6 +1,14 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 import psycopg2
+import psycopg2.errors
 import psycopg2.extras
+import psycopg2.pool
 from typing import TypedDict
+from uuid import UUID
 
 class Users(TypedDict):
     name: str
@@ -8,6 +16,38 @@ class Users(TypedDict):
     salt: bytes
     totp_secret: str
 
+class MessageRow(TypedDict):
+    chatroom_id: UUID
+    sender: str
+    message_type: str
+    length: int
+    content: bytes
+    basename: str | None
+    preview: bytes | None
+    timestamp: datetime
+
+# Length of messages.basename column
+BASENAME_MAX = 250
+
+def fit_basename(name: str) -> str:
+    """Shortens file name to fit ```BASENAME_MAX``` keeping extension."""
+    if len(name) <= BASENAME_MAX:
+        return name
+    stem, ext = os.path.splitext(name)
+    if len(ext) >= BASENAME_MAX:
+        return name[:BASENAME_MAX]
+    return stem[:BASENAME_MAX - len(ext)] + ext
+
+class HistoryRow(TypedDict):
+    id: int
+    sender: str
+    message_type: str
+    length: int
+    content: bytes
+    basename: str | None
+    preview: bytes | None
+    timestamp: datetime
+
 class NoDataFoundError(Exception):
     """Exception for handling ```None``` returns from database."""
 
@@ -15,24 +55,73 @@ class NoDataFoundError(Exception):
         super().__init__(message)
  
 
-class Connect:
-    def __init__(self, passw: str, name: str) -> None:
+class ConnectionPool:
+    """Bounded pool of database connections.
+
+    Keeps at least ```minconn``` connections open and never opens more
+    than ```maxconn```. When all connections are in use ```getconn```
+    waits for one to be returned instead of failing.
+    Connections are opened on first use, so the pool can be created
+    before server's worker processes are forked.
+    """
+
+    def __init__(self, passw: str, name: str,
+                 minconn: int = 1, maxconn: int = 10) -> None:
         self.passw = passw
         self.name = name.lower()
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self._pool = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+
+    def _open(self) -> psycopg2.pool.ThreadedConnectionPool:
+        with self._lock:
+            if self._pool is None:
+                self._pool = psycopg2.pool.ThreadedConnectionPool(
+                    self.minconn,
+                    self.maxconn,
+                    database=self.name,
+                    user="postgres",
+                    password=self.passw,
+                    host="localhost",
+                    port="5432"
+                )
+            return self._pool
+
+    def getconn(self):
+        self._slots.acquire()
+        try:
+            return self._open().getconn()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn) -> None:
+        # Pool rolls back unfinished transactions by itself
+        self._open().putconn(conn)
+        self._slots.release()
+
+    def closeall(self) -> None:
+        if self._pool is not None:
+            self._pool.closeall()
+
+
+class Connect:
+    """Borrows a connection from ```pool``` for the duration of
+    ```with``` block."""
+
+    def __init__(self, pool: ConnectionPool) -> None:
+        self.pool = pool
 
     def __enter__(self):
-        self.conn = psycopg2.connect(
-            database=self.name, 
-            user="postgres", 
-            password=self.passw, 
-            host="localhost", 
-            port="5432"
-        )
+        self.conn = self.pool.getconn()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if hasattr(self, "conn"):
-            self.conn.close()
+            self.pool.putconn(self.conn)
+            del self.conn
     
     def get_user(self, name: str, device_id: bytes = b"none") -> tuple[Users, str]:
         cur = self.conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
@@ -98,6 +187,21 @@ class Connect:
         cur.close()
         return user[0]
 
+    def get_chatrooms(self, name: str) -> list[UUID]:
+        cur = self.conn.cursor()
+        cur.execute(
+            """
+            SELECT cm.chatroom_id
+            FROM public.chatroom_members cm
+            JOIN public.users u ON cm.user_id = u.id
+            WHERE u.name = %s
+            """,
+            (name,)
+        )
+        rows = cur.fetchall()
+        cur.close()
+        return [UUID(str(row[0])) for row in rows]
+
     def add_user(self, name:str, password: bytes, 
                   salt: bytes, secret: str, 
                   device_id: bytes, public_key: str) -> None:
@@ -124,3 +228,287 @@ class Connect:
         )
         self.conn.commit()
         cur.close()
+
+    def add_messages(self, rows: list[MessageRow]) -> None:
+        """Inserts all ```rows``` with one multi-row INSERT."""
+        cur = self.conn.cursor()
+
+        psycopg2.extras.execute_values(
+            cur,
+            """INSERT INTO public.messages (chatroom_id, sender_id, 
+            message_type, length, content, basename, preview, timestamp)
+            VALUES %s""",
+            [(
+                str(row["chatroom_id"]), row["sender"], row["message_type"],
+                row["length"], psycopg2.Binary(row["content"]),
+                row["basename"],
+                None if row["preview"] is None 
+                else psycopg2.Binary(row["preview"]),
+                row["timestamp"],
+            ) for row in rows],
+            template="""(%s, (SELECT id FROM public.users WHERE name = %s),
+            %s, %s, %s, %s, %s, %s)""",
+            page_size=len(rows)
+        )
+        self.conn.commit()
+        cur.close()
+
+    def get_messages(self, chatroom_id: UUID, before: bool,
+                     cursor: tuple[datetime, int] | None,
+                     limit: int) -> list[HistoryRow]:
+        """Returns up to ```limit``` messages of a chatroom right before
+        or after ```cursor``` (timestamp and id of a message) in
+        chronological order. Without ```cursor``` the latest are returned.
+        """
+        op, order = ("<", "DESC") if before else (">", "ASC")
+        params: list = [str(chatroom_id)]
+        condition = ""
+        if cursor is not None:
+            # Plain timestamp condition lets the planner skip partitions,
+            # row comparison pins position within the same timestamp
+            condition = f"""AND m.timestamp {op}= %s
+            AND (m.timestamp, m.id) {op} (%s, %s)"""
+            params += [cursor[0], cursor[0], cursor[1]]
+        params.append(limit)
+
+        cur = self.conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute(
+            f"""
+            SELECT m.id, u.name, m.message_type, m.length, 
+                   m.content, m.basename, m.preview, m.timestamp
+            FROM public.messages m
+            JOIN public.users u ON m.sender_id = u.id
+            WHERE m.chatroom_id = %s {condition}
+            ORDER BY m.timestamp {order}, m.id {order}
+            LIMIT %s
+            """,
+            params
+        )
+        rows = cur.fetchall()
+        cur.close()
+        if before:
+            rows.reverse()
+
+        return [HistoryRow(
+            id=row["id"],
+            sender=row["name"],
+            message_type=row["message_type"],
+            length=row["length"],
+            content=bytes(row["content"]),
+            basename=row["basename"],
+            preview=None if row["preview"] is None else bytes(row["preview"]),
+            timestamp=row["timestamp"],
+        ) for row in rows]
+
+    def get_file_rooms(self, download_id: UUID,
+                       message_types: list[str]) -> list[UUID]:
+        """Returns chatrooms which got messages of ```message_types```
+        (file-like ones) with content ```download_id```."""
+        cur = self.conn.cursor()
+        cur.execute(
+            """
+            SELECT DISTINCT chatroom_id
+            FROM public.messages
+            WHERE content = %s AND message_type = ANY(%s)
+            """,
+            (psycopg2.Binary(download_id.bytes), message_types)
+        )
+        rows = cur.fetchall()
+        cur.close()
+        return [UUID(str(row[0])) for row in rows]
+
+    def manage_partitions(self) -> None:
+        """Creates partition of messages for the current week
+        and drops the outdated one."""
+        cur = self.conn.cursor()
+        cur.execute("SELECT manage_messages_partitions()")
+        self.conn.commit()
+        cur.close()
+
+
+class AsyncConnect:
+    """Same methods as ```Connect``` but awaitable.
+
+    Every call runs in a dedicated thread pool with its own connection
+    from ```pool```, so queries don't block the event loop.
+    """
+
+    def __init__(self, pool: ConnectionPool, workers: int | None = None) -> None:
+        self.pool = pool
+        # More threads than connections would only wait for the pool
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers or pool.maxconn,
+            thread_name_prefix="db"
+        )
+
+    async def _run(self, method: str, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, self._call, method, args
+        )
+
+    def _call(self, method: str, args: tuple):
+        with Connect(self.pool) as db:
+            return getattr(db, method)(*args)
+
+    async def get_user(self, name: str,
+                       device_id: bytes = b"none") -> tuple[Users, str]:
+        return await self._run("get_user", name, device_id)
+
+    async def get_pubkey(self, name: str) -> bytes:
+        return await self._run("get_pubkey", name)
+
+    async def get_by_pubkey(self, public_key: str) -> str:
+        return await self._run("get_by_pubkey", public_key)
+
+    async def get_chatrooms(self, name: str) -> list[UUID]:
+        return await self._run("get_chatrooms", name)
+
+    async def add_user(self, name:str, password: bytes, 
+                       salt: bytes, secret: str, 
+                       device_id: bytes, public_key: str) -> None:
+        await self._run(
+            "add_user", name, password, salt, secret, device_id, public_key
+        )
+
+    async def add_device(self, name:str, device_id: bytes,
+                         public_key: str) -> None:
+        await self._run("add_device", name, device_id, public_key)
+
+    async def add_messages(self, rows: list[MessageRow]) -> None:
+        await self._run("add_messages", rows)
+
+    async def get_messages(self, chatroom_id: UUID, before: bool,
+                           cursor: tuple[datetime, int] | None,
+                           limit: int) -> list[HistoryRow]:
+        return await self._run(
+            "get_messages", chatroom_id, before, cursor, limit
+        )
+
+    async def get_file_rooms(self, download_id: UUID,
+                             message_types: list[str]) -> list[UUID]:
+        return await self._run("get_file_rooms", download_id, message_types)
+
+    async def manage_partitions(self) -> None:
+        await self._run("manage_partitions")
+
+    def close(self) -> None:
+        self._executor.shutdown()
+
+
+class MessageBatcher:
+    """Buffers messages and writes them to the database in batches.
+
+    ```add``` only appends to the buffer, so relaying is never held up
+    by the database. Buffer is flushed with one INSERT once it has
+    ```batch_size``` messages or every ```interval``` seconds, whichever
+    comes first. Partitions are managed every ```partitions_interval```
+    seconds and whenever a message doesn't fit any of them.
+    If the database is unavailable, up to ```max_pending``` messages
+    are kept for the next attempt, the oldest ones are dropped first.
+    Messages the database rejects (e.g. of a deleted sender) are dropped.
+    """
+
+    def __init__(self, db: AsyncConnect, batch_size: int = 256,
+                 interval: float = 1.0, partitions_interval: float = 3600.0,
+                 max_pending: int = 65_536) -> None:
+        self.db = db
+        self.batch_size = batch_size
+        self.interval = interval
+        self.partitions_interval = partitions_interval
+        self.max_pending = max_pending
+        self._pending: list[MessageRow] = []
+        self._full = asyncio.Event()
+
+    def add(self, row: MessageRow) -> None:
+        self._pending.append(row)
+        if len(self._pending) > self.max_pending:
+            del self._pending[0]
+        if len(self._pending) >= self.batch_size:
+            self._full.set()
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        await self._manage_partitions()
+        next_partitions = loop.time() + self.partitions_interval
+
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except TimeoutError:
+                pass
+            self._full.clear()
+            try:
+                await self.flush()
+
+                if loop.time() >= next_partitions:
+                    await self._manage_partitions()
+                    next_partitions = loop.time() + self.partitions_interval
+            except Exception as e:
+                # Messages relayed later must still be saved
+                print(f"[-] Failed to save messages: {e!r}")
+
+    async def flush(self) -> None:
+        while self._pending:
+            batch = self._pending[:self.batch_size]
+            del self._pending[:self.batch_size]
+            try:
+                await self._insert(batch)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                print(f"[-] Failed to save {len(batch)} messages: {e}")
+                self._retry_later(batch)
+                return
+            except (psycopg2.DataError, psycopg2.IntegrityError):
+                # Some rows will never fit, the others are saved one by one
+                if not await self._insert_each(batch):
+                    return
+            except Exception as e:
+                # Rows themselves are malformed, retrying won't help
+                print(f"[-] Dropped {len(batch)} messages that can't be "
+                      f"saved: {e!r}")
+
+    async def _insert(self, rows: list[MessageRow]) -> None:
+        try:
+            await self.db.add_messages(rows)
+        except psycopg2.errors.CheckViolation:
+            # No partition for the timestamp (e.g. a new week began)
+            await self.db.manage_partitions()
+            await self.db.add_messages(rows)
+
+    async def _insert_each(self, batch: list[MessageRow]) -> bool:
+        """Saves rows of ```batch``` one by one dropping those that fail.
+
+        :return: ```False``` if the database became unavailable,
+                 unsaved rows are then kept for the next attempt
+        :rtype: ```bool```
+        """
+        for i, row in enumerate(batch):
+            try:
+                await self._insert([row])
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                print(f"[-] Failed to save {len(batch) - i} messages: {e}")
+                self._retry_later(batch[i:])
+                return False
+            except Exception as e:
+                print(f"[-] Dropped message of {row['sender']} sent to "
+                      f"{row['chatroom_id']} at {row['timestamp']}: {e!r}")
+        return True
+
+    def _retry_later(self, rows: list[MessageRow]) -> None:
+        self._pending[:0] = rows
+        del self._pending[:max(len(self._pending) - self.max_pending, 0)]
+
+    async def close(self) -> None:
+        """Writes the rest of the buffer, e.g. on shutdown."""
+        await self.flush()
+        if self._pending:
+            first = self._pending[0]["timestamp"]
+            last = self._pending[-1]["timestamp"]
+            print(f"[-] {len(self._pending)} messages sent from {first} "
+                  f"to {last} weren't saved.")
+
+    async def _manage_partitions(self) -> None:
+        try:
+            await self.db.manage_partitions()
+        except psycopg2.Error as e:
+            print(f"[-] Failed to manage messages partitions: {e}")
@@ -157,6 +157,9 @@ class MainWindow(QMainWindow):
             self.chat_room_list_widget.list.addWidget(chatroom)
 
     def quit(self):
+        # Pending transfers are dropped before the socket is closed
+        if hasattr(self.main_widget, "send_worker"):
+            self.main_widget.send_worker.stop()
         # Worker thread termination
         if hasattr(self.main_widget, "wk_thread"):
             self.main_widget.sender_thread.quit()
@@ -1,12 +1,12 @@
 import os
+import shutil
 from ssl import SSLSocket
 import tempfile
-from time import sleep
 from uuid import UUID
 from pathlib import Path
 
 from PySide6.QtWidgets import (QWidget, QVBoxLayout, QHBoxLayout,
-                               QPushButton, QSpacerItem, QSizePolicy,
+                               QPushButton,
                                QFileDialog, QApplication, QDialog,
                                QFrame
                                )
@@ -18,17 +18,20 @@ from Crypto.PublicKey.RSA import RsaKey
 from PIL import UnidentifiedImageError
 
 
-from .utils.tools import compress_image, qimage_to_bytes, CLIENT_DIR
-from .components import (TextBubble, SingleImage, ScrollArea,
-                         DocAttachment,AttachDialog,ChatHeader,
-                         TextArea, VideoWidget)
-from .message import ChunkSize, Tags, MessageRenderer, MsgType
+from .utils.tools import CLIENT_DIR
+from .components import AttachDialog, ChatHeader, TextArea, ChatView
+from .message import (ChunkSize, Tags, MessageRenderer, MessageModel,
+                      MsgType, unpack_history)
 from .utils.services import SenderServiceWorker, ReceiverServiceWorker
 
 
 buffer_limit = ChunkSize.K256
+# Attachments up to this size are downloaded as soon as they are
+# scrolled into view, bigger ones only on click (0 - always on click)
+auto_download = 10 * ChunkSize.M1.value
 keys_dir = Path(f"{CLIENT_DIR}/keys")
 keys_dir.mkdir(parents=True, exist_ok=True)
+documents_dir = Path(f"{CLIENT_DIR}/downloads/documents")
 
 class ChatWidget(QWidget):
     def __init__(self, s: SSLSocket | None, 
@@ -40,17 +43,13 @@ class ChatWidget(QWidget):
         self.server_pubkey = server_pubkey.export_key()
         self.main_window = window
 
-        self.scroll_area = ScrollArea()
-
-        self.chat_area = QWidget()
-        self.chat_area.setObjectName("scrollarea")
-        self.scroll_area.setWidget(self.chat_area)
-
-        self.chat_layout = QVBoxLayout(self.chat_area)
-        self.chat_layout.setSpacing(5)
-        self.chat_layout.addItem(
-            QSpacerItem(0, 0, QSizePolicy.Policy.Minimum, 
-                        QSizePolicy.Policy.Expanding))
+        # Only messages on screen have widgets, the rest are kept
+        # in the model and their widgets are made when scrolled to
+        self.messages = MessageModel()
+        self.renderer = MessageRenderer(self.messages, self, auto_download)
+        self.chat_view = ChatView(self.messages, self.renderer.create_widget,
+                                  self.renderer.measure)
+        self.chat_view.widgetsChanged.connect(self.renderer.load_visible)
 
         main_layout = QVBoxLayout()
         main_layout.setContentsMargins(0,0,0,0)
@@ -85,12 +84,9 @@ class ChatWidget(QWidget):
             #tarea{
                 border: none;
             }
-            #scrollarea{
-                background-color: #1e1e1e;
-            }     
             """
             )
-        self.scroll_area.setFocusProxy(self.send_field)
+        self.chat_view.setFocusProxy(self.send_field)
         self.attach.setFocusProxy(self.send_field)
         self.button.setFocusProxy(self.send_field)
 
@@ -105,7 +101,7 @@ class ChatWidget(QWidget):
         self.header.getCode.connect(self.on_send)
 
         main_layout.addWidget(self.header)
-        main_layout.addWidget(self.scroll_area)
+        main_layout.addWidget(self.chat_view)
         main_layout.addWidget(self.inputs)
 
         self.setLayout(main_layout)
@@ -113,10 +109,18 @@ class ChatWidget(QWidget):
         self.button.clicked.connect(self.on_send)
         self.attach.clicked.connect(self.attach_file)
 
+        # Cursor (timestamp in microseconds and id) of the oldest
+        # message shown, older ones are requested when scrolled to the top
+        self.oldest: tuple[int, int] | None = None
+        self.history_end = False
+        self.loading_history = False
+        self.chat_view.verticalScrollBar().valueChanged.connect(
+            self.on_scroll)
+
         self.room_id: UUID = UUID(int=1)
         self.change_room(UUID(int=0).bytes)
 
-    def listen_for_messages(self, name: str) -> None:
+    def listen_for_messages(self, name: str, header_version: int = 0) -> None:
         self.name = name
         with open(f"{keys_dir}/{name}_private.pem", "rb") as f:
             my_pvtkey = RSA.import_key(f.read())
@@ -133,13 +137,13 @@ class ChatWidget(QWidget):
         self.receiver_thread.start()
 
         self.send_worker = SenderServiceWorker(
-                self.s, self.name, self.server_pubkey, buffer_limit
+                self.s, self.name, self.server_pubkey, buffer_limit,
+                header_version
                 )
         self.sender_thread = QThread()
         self.send_worker.moveToThread(self.sender_thread)
         self.sender_thread.start()
-
-        self.renderer = MessageRenderer(self.chat_layout, self)
+        self.send_worker.resume_uploads()
 
     def copy_to_clip(self, text: str) -> None:
         mime_data = QMimeData()
@@ -149,28 +153,98 @@ class ChatWidget(QWidget):
     @Slot(dict, bytes)
     def on_message_received(self, header: Tags, msg: bytes) -> None:
         commands = {
-            "code": self.copy_to_clip
+            b"code": lambda _, data: self.copy_to_clip(data.decode()),
+            b"history": self.show_history,
+            b"download": self.on_download,
+            b"upload": self.on_upload_offset,
+            b"uploaded": lambda _, data: self.send_worker.on_uploaded(
+                UUID(hex=data.decode())),
+            b"upload_failed": lambda _, data: self.send_worker.on_upload_failed(
+                UUID(hex=data.decode())),
                 }
         if header["message_type"] == MsgType.SERVER:
-            cmd, data = msg.decode().split("<SEP>")
-            commands[cmd](data)
+            cmd, data = msg.split(b"<SEP>", 1)
+            commands[cmd](header, data)
+            return
+        # Other rooms get their messages from history when opened
+        if header["chatroom_id"] != self.room_id:
             return
 
         name = msg.split(b'<SEP>', 1)[0].decode()
         own = name == self.name
         self.renderer.render_message(header, msg, -1, own)
        
+    def request_history(self) -> None:
+        """Requests page of messages older than the oldest one shown."""
+        if self.loading_history or self.history_end:
+            return
+        self.loading_history = True
+        cursor = "<SEP>".join(map(str, self.oldest)) if self.oldest else ""
+        self.send_worker.send_cmd(
+                f"history<SEP>before<SEP>{cursor}".encode(), self.room_id
+                )
+
+    def show_history(self, header: Tags, data: bytes) -> None:
+        # Page may arrive after user has switched to another room
+        if header["chatroom_id"] != self.room_id:
+            return
+        self.loading_history = False
+        _, page = data.split(b"<SEP>", 1)
+        entries = unpack_history(page)
+        if not entries:
+            self.history_end = True
+            return
+
+        scrollbar = self.chat_view.verticalScrollBar()
+        from_bottom = scrollbar.maximum() - scrollbar.value()
+        first_page = self.oldest is None
+        # Older messages go to the top
+        for i, entry in enumerate(entries):
+            name = entry["data"].split(b'<SEP>', 1)[0].decode()
+            self.renderer.render_message(
+                    entry["tags"], entry["data"], i, name == self.name
+                    )
+        self.oldest = (entries[0]["timestamp_us"], entries[0]["id"])
+
+        QApplication.processEvents()
+        if first_page:
+            QTimer.singleShot(1, self.scroll_down)
+        else:
+            # Keep messages that were on screen in place
+            QTimer.singleShot(1, lambda: scrollbar.setValue(
+                scrollbar.maximum() - from_bottom))
+
+    def request_download(self, download_id: UUID) -> None:
+        self.send_worker.send_cmd(
+                f"download<SEP>{download_id.hex}".encode(), self.room_id
+                )
+
+    def on_download(self, header: Tags, data: bytes) -> None:
+        # Download id, offset and total size precede the chunk,
+        # only id is sent if there is no such file
+        dl_id = UUID(bytes=data[:16])
+        if len(data) == 16:
+            self.renderer.receive_chunk(dl_id, 0, -1, b'')
+            return
+        offset = int.from_bytes(data[16:24], "big")
+        total = int.from_bytes(data[24:32], "big")
+        self.renderer.receive_chunk(dl_id, offset, total, data[32:])
+
+    def on_upload_offset(self, header: Tags, data: bytes) -> None:
+        upload_id, offset = data.decode().split("<SEP>")
+        self.send_worker.on_upload_offset(UUID(hex=upload_id), int(offset))
+
+    def on_scroll(self, value: int) -> None:
+        if value == 0 and self.oldest is not None:
+            self.request_history()
+
     def on_send(self, cmd: str = "") -> None:
         if cmd == "@get_code":
             self.send_worker.send_cmd(b"code", self.room_id)
             return
         to_send: str = self.send_field.toPlainText().strip()
         if to_send:
-            bubble = TextBubble(self, to_send)
-            bubble.sel = self.send_field
-            bubble.chat = self.chat_area
-            self.chat_layout.addWidget(bubble, 
-                                       alignment=Qt.AlignmentFlag.AlignRight)
+            self.renderer.render_local(MsgType.TEXT, to_send.encode())
             self.send_worker.send_text(to_send.encode(), self.server_pubkey,
                                        self.room_id)
         self.send_field.clear()
@@ -198,56 +272,39 @@ class ChatWidget(QWidget):
             self.display_attach(files)
 
     def display_attach(self, files: list[tuple[str, bool]]) -> None:
+        # Attachments are only shown here, encoding and sending
+        # them is done by the transfer scheduler of the send worker
+        temp_dir = tempfile.gettempdir()
+        documents_dir.mkdir(parents=True, exist_ok=True)
         for f, pic in files:
+            # Widgets of messages are made again when scrolled to,
+            # so file grabbed from the clipboard has to be kept
+            if temp_dir in f:
+                f = shutil.move(f, f"{documents_dir}/{os.path.basename(f)}")
+            _, ext = os.path.splitext(f)
             if pic:
-                _, ext = os.path.splitext(f)
+                self.renderer.render_local(MsgType.IMAGE, path=f)
                 if ext != ".gif":
-                    compressed = compress_image(f)
                     self.send_worker.send_static_image(
-                            qimage_to_bytes(compressed),
-                            self.server_pubkey,
-                            self.room_id
+                            f, self.server_pubkey, self.room_id
                     )
-
-                    # Delete temporary file if image was grabbed
-                    # from the clipboard
-                    temp_dir = tempfile.gettempdir()
-                    if temp_dir in f:
-                        os.remove(f)
-                else:
-                    self.send_worker.send_file(f, self.server_pubkey,
-                                               self.room_id)
-                attachment = SingleImage(self, f)
+                    continue
+            elif ext == ".mp4":
+                self.renderer.render_local(MsgType.VIDEO, path=f)
             else:
-                if os.path.splitext(f)[1] == ".mp4":
-                    attachment = VideoWidget(f, self)
-                else:
-                    attachment = DocAttachment(f, parent=self)
-                self.send_worker.send_file(f, self.server_pubkey, self.room_id)
-            attachment.setFocusProxy(self.send_field)
-            self.chat_layout.addWidget(attachment,
-                                       alignment=Qt.AlignmentFlag.AlignRight)
-            sleep(0.05)
+                self.renderer.render_local(MsgType.DOCUMENT, path=f)
+            self.send_worker.send_file(f, self.server_pubkey, self.room_id)
         QApplication.processEvents()
         QTimer.singleShot(1, self.scroll_down)
 
     def scroll_down(self):
-        scrollbar = self.scroll_area.verticalScrollBar()
-        scrollbar.setValue(scrollbar.maximum())
-        self.scroll_area.old_max = scrollbar.maximum()
-        self.scroll_area.relative_position = (
-            scrollbar.value() / self.scroll_area.old_max
-            if self.scroll_area.old_max > 0 else 0)
+        self.chat_view.scrollToBottom()
 
     def resizeEvent(self, event):
         if hasattr(self, 'dialog'):
             self.dialog.update_geometry()
             event.accept()
-        for c in self.chat_area.children():
-            if c.isWidgetType():
-                # All widgets in "chat_area" should be resizable
-                # so we assume that "c" has "compute_size" attribute
-                c.compute_size() #type: ignore
+        # Chat view resizes widgets of the messages itself
 
     @Slot(bytes)
     def change_room(self, room_id: bytes) -> None:
@@ -264,9 +321,13 @@ class ChatWidget(QWidget):
             self.send_field.setDisabled(False)
         self.room_id = UUID(bytes=room_id)
         self.clear_chat()
-        # TODO: change scrollarea's content with contents of current room
+        self.oldest = None
+        self.history_end = False
+        self.loading_history = False
+        if room_id != UUID(int=0).bytes and hasattr(self, "send_worker"):
+            self.request_history()
 
     def clear_chat(self) -> None:
-        for w in self.chat_area.children()[1:]:
-            w.deleteLater()
+        if hasattr(self, "renderer"):
+            self.renderer.clear()
 
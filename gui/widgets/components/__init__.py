@@ -5,6 +5,7 @@ from .text_bubble import TextBubble
 from .single_image import SingleImage
 from .scroll_area import ScrollArea
 from .doc_attachment import DocAttachment
+from .attachment_placeholder import AttachmentPlaceholder
 from .doc_dialog import AttachDialog, Overlay
 from .chat_header import ChatHeader
 from .textarea import TextArea
@@ -13,4 +14,6 @@ from .server_dialog import ServerDialog
 from .video_widget import VideoWidget
 from .totp_dialog import TOTPDialog
 from .chatroom_list import ChatRoomList
-from .splitter import Splitter
\ No newline at end of file
+from .splitter import Splitter
+# Imports message package, which needs the widgets above
+from .chat_view import ChatView, MessageDelegate
@@ -0,0 +1,95 @@
+from datetime import datetime
+
+from PySide6.QtWidgets import (QVBoxLayout, QHBoxLayout, QLabel,
+                               QFrame, QSpacerItem, QSizePolicy, QWidget
+                               )
+from PySide6.QtGui import QCursor, QImage
+from PySide6.QtCore import Qt, Signal
+
+from . import EllipsisLabel
+from .image_preview import ImagePreview
+from ..utils.tools import format_size
+
+
+class AttachmentPlaceholder(QFrame):
+    """Shown instead of an attachment until its content is downloaded.
+    Displays ```preview``` of the content if there is one.
+    Emits ```clicked``` when user asks for the download."""
+    clicked = Signal()
+
+    def __init__(self, basename: str, size: int, name: str = "",
+                 parent: QWidget | None = None,
+                 timestamp: datetime | None = None,
+                 preview: QImage | None = None,
+                 *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.par = parent
+        self.total = size
+        self.time = (timestamp if timestamp
+                     else datetime.now()).strftime("%I:%M %p")
+
+        layout = QHBoxLayout(self)
+        layout.setContentsMargins(5,5,5,5)
+
+        info_layout = QVBoxLayout()
+        info_layout.setSpacing(5)
+        info_layout.setAlignment(Qt.AlignmentFlag.AlignTop)
+        info_layout.setContentsMargins(10,0,5,0)
+        if name:
+            name_text = QLabel(name)
+            name_font = name_text.font()
+            name_font.setBold(True)
+            name_text.setFont(name_font)
+            info_layout.addWidget(name_text)
+        info_layout.addWidget(EllipsisLabel(basename, elide="middle"))
+        self.status = QLabel(f"{format_size(size)} · Click to download")
+        self.status.setObjectName("secondary")
+        info_layout.addWidget(self.status)
+        info_layout.addItem(
+            QSpacerItem(0, 0, QSizePolicy.Policy.Minimum,
+                        QSizePolicy.Policy.Expanding))
+        time_text = QLabel(self.time)
+        time_text.setObjectName("secondary")
+        info_layout.addWidget(time_text,
+                              alignment= Qt.AlignmentFlag.AlignBottom
+                              | Qt.AlignmentFlag.AlignRight)
+
+        if preview is not None and not preview.isNull():
+            layout.addWidget(ImagePreview(preview))
+        else:
+            layout.addWidget(ImagePreview("./public/document.png"))
+        layout.addLayout(info_layout)
+
+        self.setFixedHeight(103 if name else 85)
+        self.setMinimumWidth(250)
+        self.setStyleSheet(
+            """
+            QFrame{
+            background-color: #2e2e2e;
+            border-radius: 12px;}
+            #secondary{color: gray;};
+            """
+            )
+        self.setCursor(QCursor(Qt.CursorShape.PointingHandCursor))
+
+    def set_progress(self, received: int) -> None:
+        self.status.setText(
+            f"{format_size(received)} of {format_size(self.total)}"
+            )
+
+    def set_unavailable(self) -> None:
+        self.status.setText("File is unavailable")
+        self.setCursor(QCursor(Qt.CursorShape.ArrowCursor))
+
+    def compute_size(self):
+        if self.par:
+            self.setMaximumWidth(int(min(self.par.width()*0.8, 500)))
+
+    def showEvent(self, e) -> None:
+        self.compute_size()
+        return super().showEvent(e)
+
+    def mouseReleaseEvent(self, ev):
+        if ev.button() == Qt.MouseButton.LeftButton:
+            self.clicked.emit()
+        return super().mouseReleaseEvent(ev)
@@ -69,8 +69,5 @@ class ChatHeader(QFrame):
         self.menu.close()
 
     def clear_chat(self):
-        widgets = self.p.chat_area.children()[1:]
-
-        for w in widgets:
-            w.deleteLater()
+        self.p.clear_chat()
         self.menu.close()
@@ -0,0 +1,343 @@
+from typing import Callable
+
+from PySide6.QtCore import (QEvent, QModelIndex, QPersistentModelIndex,
+                            QPoint, QRect, QSize, Qt, QTimer, Signal)
+from PySide6.QtGui import QColor, QPainter
+from PySide6.QtWidgets import (QAbstractItemView, QHBoxLayout, QListView,
+                               QStyledItemDelegate, QWidget)
+
+from ..message.message_model import MessageModel, MessageItem
+from .text_bubble import WIDTH_BUCKET
+
+# Space between messages and between messages and edges of the chat
+SPACING = 5
+MARGIN = 9
+# Sizes of a message are cached for widths of the chat rounded down
+# to WIDTH_BUCKET, and for this many different widths
+MAX_SIZES = 4
+# Rows are laid out again once the view isn't resized for that long (ms)
+RESIZE_DELAY = 100
+
+
+class MessageDelegate(QStyledItemDelegate):
+    """Gives rows the size of their messages. Rows which widgets aren't
+    created yet (e.g. while scrolling fast) get an empty bubble."""
+    def __init__(self, view: "ChatView") -> None:
+        super().__init__(view)
+        self.view = view
+
+    def sizeHint(self, option, index) -> QSize:
+        size = self.view.message_size(self.view.item(index))
+        return QSize(self.view.viewport().width(), size.height() + SPACING)
+
+    def paint(self, painter, option, index) -> None:
+        item = self.view.item(index)
+        if self.view.widget(item) is not None:
+            return
+        rect = QRect(QPoint(0, option.rect.top()),
+                     self.view.message_size(item))
+        if item.own:
+            rect.moveRight(option.rect.right() - MARGIN)
+        else:
+            rect.moveLeft(option.rect.left() + MARGIN)
+
+        painter.save()
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+        painter.setPen(Qt.PenStyle.NoPen)
+        painter.setBrush(QColor("#2e2e2e"))
+        painter.drawRoundedRect(rect, 12, 12)
+        painter.restore()
+
+
+class ChatView(QListView):
+    """Chat timeline over a ```MessageModel```.
+
+    Widgets of messages are made by ```factory``` only for rows in
+    the viewport and a screen above and below it, and are deleted once
+    they are scrolled away, so the number of live widgets doesn't depend
+    on the length of the history. Rows without widgets are sized by
+    ```measure``` until their widget is created and its real size is known.
+    """
+    # Emitted after widgets were created for rows scrolled into view
+    widgetsChanged = Signal()
+
+    def __init__(
+            self, model: MessageModel,
+            factory: Callable[[MessageItem], QWidget],
+            measure: Callable[[MessageItem, int], QSize],
+            color: str = "#1e1e1e", *args, **kwargs
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self.factory = factory
+        self.measure = measure
+        # Message -> row container, message widget and index of the row
+        self._live: dict[
+            MessageItem, tuple[QWidget, QWidget, QPersistentModelIndex]
+        ] = {}
+        self._owners: dict[QWidget, MessageItem] = {}
+        # Top margin that keeps few messages at the bottom of the chat
+        self._pad = 0
+        # Change of height of rows above the viewport to scroll by,
+        # so the messages on screen stay in place
+        self._shift = 0
+        self._at_bottom = True
+
+        self.setModel(model)
+        self.setItemDelegate(MessageDelegate(self))
+        self.setVerticalScrollMode(
+            QAbstractItemView.ScrollMode.ScrollPerPixel)
+        self.setHorizontalScrollBarPolicy(
+            Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
+        # Rows are laid out after resizing is over, see resizeEvent()
+        self.setResizeMode(QListView.ResizeMode.Fixed)
+        self.setSelectionMode(QAbstractItemView.SelectionMode.NoSelection)
+        self.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+
+        self._update_timer = QTimer(self)
+        self._update_timer.setSingleShot(True)
+        self._update_timer.setInterval(0)
+        self._update_timer.timeout.connect(self._update_widgets)
+        self._resize_timer = QTimer(self)
+        self._resize_timer.setSingleShot(True)
+        self._resize_timer.setInterval(RESIZE_DELAY)
+        self._resize_timer.timeout.connect(self._on_resized)
+
+        model.rowsInserted.connect(self._update_timer.start)
+        model.rowsAboutToBeRemoved.connect(self._on_rows_removed)
+        model.modelAboutToBeReset.connect(self._on_reset)
+        model.dataChanged.connect(self._on_data_changed)
+        scrollbar = self.verticalScrollBar()
+        scrollbar.valueChanged.connect(self._on_scroll)
+        scrollbar.rangeChanged.connect(self._on_range_changed)
+
+        self.setStyleSheet(
+            """
+            QListView{
+                background-color: """ + color + """;
+                border: none;
+            }
+            QScrollBar:vertical {
+                width: 7px;
+                background-color: transparent;
+                border: none;
+            }
+            QScrollBar::add-line:vertical, QScrollBar::sub-line:vertical
+            {
+                border-image: url(:/qss_icons/rc/down_arrow_disabled.png);
+            }
+            QScrollBar::handle:vertical {
+                background: #5e5e5e;
+                min-height: 20px;
+                border-radius: 2px;
+                margin: 5px 3px 5px 0px;
+                subcontrol-origin: margin;
+            }
+            QScrollBar::add-page:vertical, QScrollBar::sub-page:vertical {
+                background-color: none;
+            }
+            """
+            )
+        scrollbar.setVisible(False)
+        self.hide_timer = QTimer(self)
+        self.hide_timer.setSingleShot(True)
+        self.hide_timer.timeout.connect(self._hide_scrollbar)
+
+    def item(self, index: QModelIndex) -> MessageItem:
+        return self.model().items[index.row()]
+
+    def message_size(self, item: MessageItem) -> QSize:
+        """Size of the widget of ```item``` at the current width.
+
+        Message that was never measured is measured right away.
+        Otherwise, if it wasn't measured at this width, its latest size
+        is used until it is scrolled into view and its widget tells
+        the real one, so resizing doesn't measure the whole history.
+        """
+        # Width of the whole view doesn't change when scrollbar is shown
+        size = item.sizes.get(self.width() // WIDTH_BUCKET)
+        if size is not None:
+            return size
+        if item.sizes:
+            return next(reversed(item.sizes.values()))
+        size = self.measure(item, self.width())
+        self._remember(item, size)
+        return size
+
+    def widget(self, item: MessageItem) -> QWidget | None:
+        """Widget of ```item``` if it is scrolled into view."""
+        live = self._live.get(item)
+        return live[1] if live else None
+
+    def is_visible(self, item: MessageItem) -> bool:
+        live = self._live.get(item)
+        return live is not None and not live[0].visibleRegion().isEmpty()
+
+    def visible_rows(self, margin: int = 0) -> range:
+        """Rows which are on screen or less than ```margin``` pixels
+        away from it."""
+        model = self.model()
+        count = model.rowCount()
+        if not count:
+            return range(0)
+        height = self.viewport().height()
+        index = self.indexAt(QPoint(1, 1))
+        first = last = index.row() if index.isValid() else 0
+        while (first > 0 and self.visualRect(
+                model.index(first - 1)).bottom() >= -margin):
+            first -= 1
+        while (last + 1 < count and self.visualRect(
+                model.index(last + 1)).top() <= height + margin):
+            last += 1
+        return range(first, last + 1)
+
+    def updateGeometries(self) -> None:
+        super().updateGeometries()
+        scrollbar = self.verticalScrollBar()
+        scrollbar.setSingleStep(20)
+        if self._shift:
+            scrollbar.setValue(scrollbar.value() + self._shift)
+            self._shift = 0
+        pad = max(0, self.contentsRect().height()
+                  - self.contentsSize().height())
+        if pad != self._pad:
+            self._pad = pad
+            self.setViewportMargins(0, pad, 0, 0)
+        # Rows may have moved after the layout
+        model = self.model()
+        for container, _, index in self._live.values():
+            container.setGeometry(self.visualRect(model.index(index.row())))
+
+    def resizeEvent(self, e) -> None:
+        super().resizeEvent(e)
+        # Messages are resized and rows laid out once the size settles,
+        # until then rows only follow the width of the view
+        width = self.viewport().width()
+        for container, _, _ in self._live.values():
+            container.resize(width, container.height())
+        self._resize_timer.start()
+
+    def eventFilter(self, watched, event) -> bool:
+        if watched in self._owners:
+            match event.type():
+                case QEvent.Type.Resize:
+                    self._track(self._owners[watched], watched.size())
+                case QEvent.Type.DeferredDelete:
+                    # Message deletes itself with "Delete" in its context
+                    # menu, so its row goes away (along with the widget)
+                    self.model().remove(self._owners[watched])
+                    return True
+        return super().eventFilter(watched, event)
+
+    def wheelEvent(self, e) -> None:
+        self.verticalScrollBar().setVisible(True)
+        self.hide_timer.start(1500)
+        super().wheelEvent(e)
+
+    def enterEvent(self, event) -> None:
+        self.verticalScrollBar().setVisible(True)
+        self.hide_timer.start(1500)
+        return super().enterEvent(event)
+
+    def leaveEvent(self, event) -> None:
+        self.hide_timer.start(1500)
+        return super().leaveEvent(event)
+
+    def _hide_scrollbar(self) -> None:
+        self.verticalScrollBar().setVisible(False)
+
+    def _update_widgets(self) -> None:
+        # Rows must be at their places before it is known which are visible
+        self.executeDelayedItemsLayout()
+        rows = self.visible_rows(self.viewport().height())
+        for item, (_, _, index) in list(self._live.items()):
+            if index.row() not in rows:
+                self._drop(item)
+        items = self.model().items
+        for row in rows:
+            if items[row] not in self._live:
+                self._create(row, items[row])
+        self.widgetsChanged.emit()
+
+    def _create(self, row: int, item: MessageItem) -> None:
+        message = self.factory(item)
+        # Row gets the real size of the message right away
+        message.compute_size() #type: ignore
+        container = QWidget()
+        layout = QHBoxLayout(container)
+        layout.setContentsMargins(MARGIN, 0, MARGIN, SPACING)
+        layout.setSpacing(0)
+        if item.own:
+            layout.addStretch()
+        layout.addWidget(message, alignment=Qt.AlignmentFlag.AlignTop)
+        if not item.own:
+            layout.addStretch()
+
+        # Widgets are placed over rows by the view itself, because
+        # setIndexWidget() makes the whole list lay out again
+        index = self.model().index(row)
+        self._live[item] = (container, message, QPersistentModelIndex(index))
+        self._owners[message] = item
+        message.installEventFilter(self)
+        container.setParent(self.viewport())
+        container.setGeometry(self.visualRect(index))
+        container.show()
+
+    def _drop(self, item: MessageItem) -> None:
+        container, message, index = self._live.pop(item)
+        del self._owners[message]
+        message.removeEventFilter(self)
+        container.hide()
+        container.deleteLater()
+
+    def _on_resized(self) -> None:
+        for _, message, _ in self._live.values():
+            message.compute_size() #type: ignore
+        self.scheduleDelayedItemsLayout()
+        self._update_timer.start()
+
+    def _remember(self, item: MessageItem, size: QSize) -> None:
+        bucket = self.width() // WIDTH_BUCKET
+        item.sizes.pop(bucket, None)
+        item.sizes[bucket] = QSize(size)
+        if len(item.sizes) > MAX_SIZES:
+            del item.sizes[next(iter(item.sizes))]
+
+    def _track(self, item: MessageItem, size: QSize) -> None:
+        old = self.message_size(item)
+        self._remember(item, size)
+        if size.height() == old.height() or item not in self._live:
+            return
+        index = self.model().index(self._live[item][2].row())
+        if not self._at_bottom and self.visualRect(index).bottom() < 0:
+            self._shift += size.height() - old.height()
+        self.itemDelegate().sizeHintChanged.emit(index)
+
+    def _on_rows_removed(self, parent, first: int, last: int) -> None:
+        items = self.model().items
+        for row in range(first, last + 1):
+            if items[row] in self._live:
+                self._drop(items[row])
+        self._update_timer.start()
+
+    def _on_reset(self) -> None:
+        for item in list(self._live):
+            self._drop(item)
+
+    def _on_data_changed(self, top_left: QModelIndex,
+                         bottom_right: QModelIndex, roles=()) -> None:
+        items = self.model().items
+        for row in range(top_left.row(), bottom_right.row() + 1):
+            if items[row] in self._live:
+                self._drop(items[row])
+            self.itemDelegate().sizeHintChanged.emit(self.model().index(row))
+        self._update_timer.start()
+
+    def _on_scroll(self, value: int) -> None:
+        scrollbar = self.verticalScrollBar()
+        self._at_bottom = value >= scrollbar.maximum()
+        self._update_timer.start()
+
+    def _on_range_changed(self, minimum: int, maximum: int) -> None:
+        # Newest messages stay in view while they arrive
+        if self._at_bottom:
+            self.verticalScrollBar().setValue(maximum)
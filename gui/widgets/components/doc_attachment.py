@@ -16,7 +16,7 @@ from PySide6.QtCore import Qt, QEvent, QMimeData
 
 from . import EllipsisLabel, CustomMenu
 from .image_preview import ImagePreview
-from ..utils.tools import CLIENT_DIR
+from ..utils.tools import CLIENT_DIR, format_size
 
 
 documents_dir = Path(f"{CLIENT_DIR}/downloads/documents")
@@ -37,21 +37,7 @@ class DocAttachment(QFrame):
                      else datetime.now()).strftime("%I:%M %p")
         _, ext = os.path.splitext(path)
         self.filename = os.path.basename(path)
-        filesize = os.path.getsize(path)
-        kb = filesize / 1024
-        mb = kb / 1024
-        gb = mb / 1024
-
-        if gb > 1:
-            filesize = f"{gb:.1f} GB"
-        elif mb > 1:
-            filesize = f"{mb:.1f} MB"
-        elif kb > 1:
-            filesize = f"{kb:.1f} KB"
-        elif str(filesize)[-1] == "1":
-            filesize = f"{filesize} byte"
-        else:
-            filesize = f"{filesize} bytes"
+        filesize = format_size(os.path.getsize(path))
 
         if ext.lower() in picture_type:
             self.preview = ImagePreview(path)
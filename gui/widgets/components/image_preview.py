@@ -1,5 +1,5 @@
 from PySide6.QtWidgets import QLabel
-from PySide6.QtCore import Qt, QRectF, QRect
+from PySide6.QtCore import Qt, QRectF
 from PySide6.QtGui import (
     QCursor, 
     QPainter, 
@@ -7,6 +7,7 @@ from PySide6.QtGui import (
     QImageReader, 
     QPainterPath,
     QTransform, 
+    QImage,
     )
 
 from ..utils.tools import compress_image
@@ -22,8 +23,14 @@ class ImagePreview(QLabel):
             image_reader = QImageReader(self.path)
             image_reader.setAutoTransform(True)
             image = image_reader.read()
+        elif isinstance(path, QImage):
+            # Already small enough, e.g. preview sent by the server
+            image = path
         else:
             image = compress_image(path, size)
+        # Cropped and rounded pixmap that is painted, see _thumbnail()
+        self._thumb: QPixmap | None = None
+        self._thumb_key: tuple[int, int, float] | None = None
         pixmap = QPixmap.fromImage(image)
         self.setPixmap(pixmap)
         self._pixmap = pixmap
@@ -38,26 +45,44 @@ class ImagePreview(QLabel):
         if not arg__1:
             return
         self._pixmap = arg__1
-    
+        self._thumb = None
+        self.update()
+
     def paintEvent(self, arg__1):
         super().paintEvent(arg__1)
 
         painter = QPainter(self)
-        painter.setRenderHint(QPainter.RenderHint.Antialiasing, True)
-        path = QPainterPath()
-        path.addRoundedRect(QRectF(self.rect()), self.radius, self.radius)
-        painter.setClipPath(path)
+        painter.drawPixmap(0, 0, self._thumbnail())
+        painter.end()
 
-        crop_size = min(self._pixmap.width(), self._pixmap.height())
+    def _thumbnail(self) -> QPixmap:
+        """Image cropped to the preview and rounded, it is rendered again
+        only after the image, the size or the device pixel ratio changes."""
+        ratio = self.devicePixelRatioF()
+        key = (self.w, self.h, ratio)
+        if self._thumb is not None and self._thumb_key == key:
+            return self._thumb
 
-        image = self._pixmap.toImage()
-        transform = QTransform()
-        transform = transform.scale(self.w / crop_size, self.h / crop_size)
-        image = image.transformed(transform, Qt.TransformationMode.SmoothTransformation)
-        pixmap = QPixmap.fromImage(image)
+        w, h = round(self.w * ratio), round(self.h * ratio)
+        crop_size = max(min(self._pixmap.width(), self._pixmap.height()), 1)
+        transform = QTransform().scale(w / crop_size, h / crop_size)
+        image = self._pixmap.toImage().transformed(
+            transform, Qt.TransformationMode.SmoothTransformation)
 
-        center_x = (pixmap.width() - self.w) // 2
-        center_y = (pixmap.height() - self.h) // 2
+        thumb = QPixmap(w, h)
+        thumb.fill(Qt.GlobalColor.transparent)
+        painter = QPainter(thumb)
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing, True)
+        path = QPainterPath()
+        path.addRoundedRect(QRectF(0, 0, w, h),
+                            self.radius * ratio, self.radius * ratio)
+        painter.setClipPath(path)
+        center_x = (image.width() - w) // 2
+        center_y = (image.height() - h) // 2
+        painter.drawImage(0, 0, image, center_x, center_y, w, h)
+        painter.end()
+        thumb.setDevicePixelRatio(ratio)
 
-        painter.drawPixmap(self.rect(), pixmap, QRect(center_x, center_y, self.w, self.h))
-        painter.end()
\ No newline at end of file
+        self._thumb = thumb
+        self._thumb_key = key
+        return thumb
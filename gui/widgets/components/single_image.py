@@ -1,5 +1,7 @@
 import os
 import subprocess
+from collections import OrderedDict
+from functools import lru_cache
 import platform
 import shutil
 from datetime import datetime
@@ -10,10 +12,10 @@ from PySide6.QtWidgets import (
     QPushButton, QVBoxLayout,  QSizePolicy,
     QLabel, QFileDialog, QApplication, QWidget,
     )
-from PySide6.QtCore import Qt, QMimeData, QUrl, QPoint
+from PySide6.QtCore import Qt, QMimeData, QUrl, QPoint, QSize
 from PySide6.QtGui import (
     QCursor, QPainter, QPixmap, 
-    QMovie, QDrag, QImage
+    QMovie, QDrag, QImage, QPainterPath, QRegion
     )
 
 from .custom_menu import CustomMenu
@@ -22,6 +24,64 @@ from ..utils.tools import compress_image, generate_name, CLIENT_DIR
 images_dir = Path(f"{CLIENT_DIR}/downloads/images")
 images_dir.mkdir(parents=True, exist_ok=True)
 
+RADIUS = 12
+# Images scaled to the size they are shown at, the least recently
+# shown are dropped first
+MAX_SCALED = 64
+_scaled: OrderedDict[tuple[str, int, int, float], QPixmap] = OrderedDict()
+
+
+@lru_cache(maxsize=64)
+def rounded_mask(width: int, height: int) -> QRegion:
+    """Mask with rounded corners shared by images of the same size.
+    Hits and misses are available through ```rounded_mask.cache_info()```."""
+    mask = QPixmap(width, height)
+    mask.fill(Qt.GlobalColor.transparent)
+    painter = QPainter(mask)
+    painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+    painter.setBrush(Qt.GlobalColor.black)
+    painter.setPen(Qt.PenStyle.NoPen)
+    painter.drawRoundedRect(0, 0, width, height, RADIUS, RADIUS)
+    painter.end()
+    return QRegion(mask.mask())
+
+
+def scaled_pixmap(
+        key: str, source: QPixmap, size: QSize, ratio: float
+) -> QPixmap:
+    """```source``` scaled to ```size``` with rounded corners for
+    a screen with device pixel ratio ```ratio```.
+
+    Pixmap is made once per ```key``` (the image), size and ratio,
+    so widgets of the same image created again while scrolling reuse it.
+    """
+    cache_key = (key, size.width(), size.height(), ratio)
+    pixmap = _scaled.get(cache_key)
+    if pixmap is not None:
+        _scaled.move_to_end(cache_key)
+        return pixmap
+
+    scaled = source.scaled(
+        size * ratio, Qt.AspectRatioMode.IgnoreAspectRatio,
+        Qt.TransformationMode.SmoothTransformation
+        )
+    pixmap = QPixmap(scaled.size())
+    pixmap.fill(Qt.GlobalColor.transparent)
+    path = QPainterPath()
+    path.addRoundedRect(0, 0, scaled.width(), scaled.height(),
+                        RADIUS * ratio, RADIUS * ratio)
+    painter = QPainter(pixmap)
+    painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+    painter.setClipPath(path)
+    painter.drawPixmap(0, 0, scaled)
+    painter.end()
+    pixmap.setDevicePixelRatio(ratio)
+
+    _scaled[cache_key] = pixmap
+    if len(_scaled) > MAX_SCALED:
+        _scaled.popitem(last=False)
+    return pixmap
+
 class SingleImage(QLabel):
     def __init__(
             self, parent: QWidget, path: QImage | str = "", name: str = "",
@@ -49,8 +109,13 @@ class SingleImage(QLabel):
                     self.image = path
                 self._pixmap = QPixmap.fromImage(self.image)
                 self.setPixmap(self._pixmap)
+        # Frames of a movie are scaled after it starts
+        self.source_size = (self._pixmap.currentPixmap().size()
+                            if isinstance(self._pixmap, QMovie)
+                            else self._pixmap.size())
         self._resized = False
-        self.setScaledContents(True)
+        # Pixmap is scaled once by compute_size(), not on every paint
+        self.setScaledContents(False)
         self.setCursor(QCursor(Qt.CursorShape.PointingHandCursor))
         self.time = (timestamp if timestamp
                      else datetime.now()).strftime("%I:%M %p")
@@ -149,13 +214,27 @@ class SingleImage(QLabel):
         return super().mouseReleaseEvent(ev)
 
     def compute_size(self):
+        size = SingleImage.measure(self.source_size, self.p.size().width())
+        if size == self.size() and not self.mask().isEmpty():
+            return
+        self.setFixedSize(size)
+
         if isinstance(self._pixmap, QMovie):
-            pixmap = self._pixmap.currentPixmap()
+            # Frames are scaled once when they are decoded
+            self._pixmap.setScaledSize(size)
         else:
-            pixmap = self._pixmap
-        parent_width = self.p.size().width()
-        pw = max(pixmap.width(), 100)
-        aspect_ratio = pixmap.height() / pixmap.width()
+            self.setPixmap(scaled_pixmap(
+                self.path or str(self._pixmap.cacheKey()),
+                self._pixmap, size, self.devicePixelRatioF()
+                ))
+        self.setMask(rounded_mask(size.width(), size.height()))
+
+    @staticmethod
+    def measure(source: QSize, parent_width: int) -> QSize:
+        """Size of an image ```source``` big in a chat
+        ```parent_width``` wide."""
+        pw = max(source.width(), 100)
+        aspect_ratio = source.height() / max(source.width(), 1)
         new_width = min(parent_width * 0.8, 500, pw)
         new_height = new_width * aspect_ratio
 
@@ -163,18 +242,7 @@ class SingleImage(QLabel):
             new_height = 600
             new_width = new_height / aspect_ratio
 
-        self.setFixedSize(int(new_width), int(new_height))
-
-        mask = QPixmap(self.size())
-        mask.fill(Qt.GlobalColor.transparent)
-        painter = QPainter(mask)
-        painter.setRenderHint(QPainter.RenderHint.Antialiasing)
-        painter.setBrush(Qt.GlobalColor.black)
-        painter.setPen(Qt.PenStyle.NoPen)
-
-        painter.drawRoundedRect(self.rect(), 12, 12)
-        painter.end()
-        self.setMask(mask.mask())
+        return QSize(int(new_width), int(new_height))
 
     def resizeEvent(self, event):
         while self.counter < 1:
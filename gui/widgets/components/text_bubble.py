@@ -1,4 +1,5 @@
 from datetime import datetime
+from functools import lru_cache
 
 from PySide6.QtWidgets import (
     QVBoxLayout, 
@@ -8,6 +9,7 @@ from PySide6.QtWidgets import (
     QWidget
     )
 from PySide6.QtGui import (
+    QFont,
     QFontMetrics, 
     QPainter, 
     QColor,
@@ -15,11 +17,52 @@ from PySide6.QtGui import (
     QTextDocument, 
     QCursor,
     )
-from PySide6.QtCore import Qt
+from PySide6.QtCore import Qt, QSize
 
 from .custom_menu import CustomMenu
 from .textarea import TextArea
 
+# Makes room for the time in the last line of the text
+PADDING = " " * 20 + "\u200B"
+UNKNOWN_TEXT = ("This message cannot be displayed.\n"
+                "Update your app to see the content of this message.")
+# Bubbles are measured for widths of the chat rounded down to this
+# step, so resizing the chat doesn't miss the caches on every pixel
+WIDTH_BUCKET = 20
+
+@lru_cache(maxsize=16)
+def _font(desc: str) -> QFont:
+    font = QFont()
+    font.fromString(desc)
+    return font
+
+@lru_cache(maxsize=4096)
+def text_width_of(text: str, name: str, font: str) -> float:
+    """Width a bubble needs to fit ```text``` and ```name``` without
+    wrapping. ```font``` is ```QFont.toString()``` of the bubble's font.
+    Hits and misses are available through ```text_width_of.cache_info()```."""
+    metrics = QFontMetrics(_font(font))
+    lines = text.split('\n')
+    return max(
+        (max(metrics.horizontalAdvance(line) for line in lines) + 85),
+        (metrics.horizontalAdvance(name) * 1.185 if name else 0)
+        )
+
+@lru_cache(maxsize=4096)
+def text_height(text: str, named: bool, font: str, width: int) -> int:
+    """Height of a bubble ```width``` wide with ```text```. Chats wider
+    than the text need give bubbles the same width, so they share
+    the entry. Hits and misses are available through
+    ```text_height.cache_info()```."""
+    doc = QTextDocument(text + PADDING)
+    doc.setDefaultFont(_font(font))
+    doc.setTextWidth(width)
+    doc.setDocumentMargin(9.0)
+    height = doc.size().height() - 6
+    if named:
+        height += 13
+    return int(height)
+
 class TextBubble(QTextEdit):
     def __init__(
             self, parent: QWidget, text, name=None,
@@ -35,7 +78,7 @@ class TextBubble(QTextEdit):
         self.time_text = (timestamp if timestamp
                           else datetime.now()).strftime("%I:%M %p")
         self.metrics = QFontMetrics(self.font())
-        self.padding = " " * 20 + "\u200B"
+        self.padding = PADDING
         self.setVerticalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
         style = """
             padding-left: 5px; 
@@ -78,7 +121,7 @@ class TextBubble(QTextEdit):
             font.setItalic(True)
             self.setFont(font)
             self.setStyleSheet(style + " color: gray;")
-            self.setText("This message cannot be displayed.\nUpdate your app to see the content of this message.")
+            self.setText(UNKNOWN_TEXT)
 
         self.counter = 0 
         self.sel: TextArea
@@ -99,32 +142,27 @@ class TextBubble(QTextEdit):
         return super().resizeEvent(e)
 
     def compute_size(self):
-        text = self.toPlainText()
-        parent_width = self.p.size().width()
-        lines = text.split('\n')
-        text_width = max(
-            (max(
-                self.metrics.horizontalAdvance(line) for line in lines) + 85),
-                (self.metrics.horizontalAdvance(self.name.text()) 
-                 * 1.185 if self.name else 0)
+        size = TextBubble.measure(
+            self.toPlainText(), self.name.text() if self.name else "",
+            self.font(), self.p.size().width()
             )
-        if text_width > parent_width * 0.8:
-            text_width = parent_width * 0.8
-
-        self.setFixedWidth(min(int(text_width), 500))
+        self.setFixedWidth(size.width())
+        self.setFixedHeight(size.height())
 
-        doc = QTextDocument(self.toPlainText() + self.padding)
-        doc.setDefaultFont(self.font())
-        doc.setTextWidth(self.width())
-        doc.setDocumentMargin(9.0)
-        text_height = doc.size().height() - 6
-        if self.name:
-            text_height += 13
-        self.setFixedHeight(int(text_height))
+    @staticmethod
+    def measure(text: str, name: str, font: QFont, parent_width: int) -> QSize:
+        """Size of a bubble with ```text``` in a chat ```parent_width```
+        wide, so it is known before the bubble is created.
+        Measurements are cached, see ```text_width_of``` and ```text_height```."""
+        desc = font.toString()
+        parent_width = parent_width // WIDTH_BUCKET * WIDTH_BUCKET
+        text_width = min(text_width_of(text, name, desc), parent_width * 0.8)
+        width = min(int(text_width), 500)
+        return QSize(width, text_height(text, bool(name), desc, width))
 
     def focusInEvent(self, e) -> None:
-        for o in self.chat.children():
-            if isinstance(o, TextBubble) and o != self:
+        for o in self.chat.findChildren(TextBubble):
+            if o != self:
                 cursor = o.textCursor()
                 cursor.clearSelection()
                 o.setTextCursor(cursor) 
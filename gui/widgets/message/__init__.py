@@ -4,11 +4,32 @@ from .misc import (
     Tags,
     FileTags,
     VMediaTags,
+    HistoryEntry,
     msg_encrypt,
+    coalesce_frames,
+    HEADER_VERSION,
+    HEADER_V1,
     FILELIKE,
     PICTURE_EXT,
 )
-from .parser import HeaderParser, generate_header
+from .parser import (
+    HeaderParser,
+    generate_header,
+    pack_header,
+    unpack_header,
+    pack_history,
+    unpack_history,
+)
 from .sender import Sender, AsyncSender
-from .receiver import Receiver, AsyncReceiver
+from .receiver import (
+    Receiver,
+    AsyncReceiver,
+    MessageSink,
+    BufferSink,
+    FileSink,
+    BlobSink,
+    BlobStorage,
+)
+from .outbox import Outbox, SlowConsumer
+from .message_model import MessageModel, MessageItem
 from .message_renderer import MessageRenderer
@@ -0,0 +1,64 @@
+from PySide6.QtCore import QAbstractListModel, QModelIndex, QSize, Qt
+
+from .misc import Tags
+
+
+class MessageItem():
+    """Message of the chat timeline.
+
+    Widget of a message exists only while it is scrolled into view,
+    so everything needed to create it again is kept here.
+    """
+    def __init__(
+            self, header: Tags, msg: bytes, own: bool, path: str = ""
+    ) -> None:
+        self.header = header
+        self.msg = msg
+        self.own = own
+        # Content of an attachment on disk, empty until it is downloaded
+        self.path = path
+        # Sizes of the widget in chats of different widths,
+        # the last one is the latest (see ChatView.message_size)
+        self.sizes: dict[int, QSize] = {}
+        # Size of the image or video shown by the widget if it is known
+        self.source_size: QSize | None = None
+
+
+class MessageModel(QAbstractListModel):
+    """List of ```MessageItem```s from the oldest to the newest."""
+    def __init__(self, parent=None) -> None:
+        super().__init__(parent)
+        self.items: list[MessageItem] = []
+
+    def rowCount(self, parent=QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.items)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid() or role != Qt.ItemDataRole.UserRole:
+            return None
+        return self.items[index.row()]
+
+    def insert(self, row: int, item: MessageItem) -> None:
+        """Inserts ```item``` before ```row```, -1 appends it."""
+        if row < 0:
+            row = len(self.items)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.items.insert(row, item)
+        self.endInsertRows()
+
+    def remove(self, item: MessageItem) -> None:
+        row = self.items.index(item)
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self.items[row]
+        self.endRemoveRows()
+
+    def refresh(self, item: MessageItem) -> None:
+        """Tells views that ```item``` has to be shown by a new widget."""
+        item.sizes.clear()
+        index = self.index(self.items.index(item))
+        self.dataChanged.emit(index, index)
+
+    def clear(self) -> None:
+        self.beginResetModel()
+        self.items.clear()
+        self.endResetModel()
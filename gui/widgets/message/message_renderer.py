@@ -1,100 +1,222 @@
 from datetime import datetime
 import os
 from pathlib import Path
+from typing import Iterator
+from uuid import UUID
 
-from PySide6.QtCore import Qt
-from PySide6.QtGui import QImage
-from PySide6.QtWidgets import QVBoxLayout, QWidget
+from PySide6.QtCore import QSize
+from PySide6.QtGui import QFont, QImage, QImageReader
+from PySide6.QtWidgets import QWidget
 
-from ..components import TextBubble, SingleImage, VideoWidget, DocAttachment
-from ..utils.tools import generate_name, CLIENT_DIR
-from . import Tags, MsgType
+from ..components import (TextBubble, SingleImage, VideoWidget,
+                          DocAttachment, AttachmentPlaceholder)
+from ..components.text_bubble import UNKNOWN_TEXT
+from ..utils.tools import CLIENT_DIR
+from . import Tags, MsgType, FileSink, FILELIKE
+from .message_model import MessageModel, MessageItem
 
 
 documents_dir = Path(f"{CLIENT_DIR}/downloads/documents")
 
 class MessageRenderer():
-    def __init__(self, layout: QVBoxLayout, parent: QWidget) -> None:
-        self.layout = layout
+    """Adds messages to ```model``` and creates widgets for them when
+    the chat view asks for ones (see ```ChatView```)."""
+    def __init__(
+            self, model: MessageModel, parent: QWidget,
+            auto_download: int = 0
+    ) -> None:
+        self.model = model
         self.p = parent
+        # Attachments up to this size are downloaded once they are
+        # scrolled into view, bigger ones (or all if 0) only on click
+        self.auto_download = auto_download
         self.renderers = {
             MsgType.TEXT: self._render_text_msg,
-            MsgType.IMAGE: self._render_img_msg,
-            MsgType.VIDEO: self._render_vid_msg,
-            MsgType.DOCUMENT: self._render_doc_msg,
             MsgType.UNKNOWN: self._render_unknown_msg,
         }
+        # Download id -> messages waiting for its content
+        self.pending: dict[UUID, list[MessageItem]] = {}
+        # Download id -> file being downloaded and bytes received so far
+        self.downloads: dict[UUID, tuple[FileSink, int]] = {}
+        # Download ids the server has no content for
+        self.unavailable: set[UUID] = set()
 
     def render_message(
             self, header: Tags, msg: bytes = b'',
             pos: int = -1, own: bool = True
     ) -> None:
-        # Chooses appropriate function based on the message type
-        self.renderers[header['message_type']](header, msg, pos, own)
-
-    def _render_text_msg(
-            self, header: Tags, msg: bytes, pos: int, own: bool
+        item = MessageItem(header, msg, own)
+        if header['message_type'] in FILELIKE:
+            # Server sends only download id of the content
+            # and its preview if there is one
+            path = download_path(header)
+            if os.path.exists(path):
+                # Already downloaded
+                item.path = path
+            else:
+                dl_id = header['download_id'] #type: ignore
+                self.pending.setdefault(dl_id, []).append(item)
+        self.model.insert(pos, item)
+
+    def render_local(self, typ: MsgType, data: bytes = b'',
+                     path: str = "") -> None:
+        """Shows message sent by this client, ```path``` is
+        the file sent as an attachment."""
+        header = Tags(
+            message_type=typ,
+            message_length=len(data),
+            chatroom_id=self.p.room_id,
+            timestamp=datetime.now().astimezone(),
+        )
+        self.model.insert(-1, MessageItem(header, b'<SEP>' + data, True, path))
+
+    def create_widget(self, item: MessageItem) -> QWidget:
+        """Creates widget of a message that is scrolled into view."""
+        header = item.header
+        if header['message_type'] not in FILELIKE:
+            # Chooses appropriate function based on the message type
+            return self.renderers[header['message_type']](item)
+        if item.path:
+            return self._render_file(item)
+        return self._render_pending(item)
+
+    def measure(self, item: MessageItem, width: int) -> QSize:
+        """Estimated size of the widget of a message which
+        is not created yet in a chat ```width``` wide."""
+        typ = item.header['message_type']
+        _, name, data = self._get_data(item.header, item.msg, item.own)
+        if typ == MsgType.TEXT:
+            return TextBubble.measure(data.decode(), name, QFont(), width)
+        if typ not in FILELIKE:
+            return TextBubble.measure(UNKNOWN_TEXT, name, QFont(), width)
+
+        if item.path and typ == MsgType.IMAGE:
+            if item.source_size is None:
+                # Reads only the header of the image
+                item.source_size = QImageReader(item.path).size()
+            return SingleImage.measure(item.source_size, width)
+        if item.path and typ == MsgType.VIDEO:
+            # Size of a video is known once it is loaded
+            return item.source_size or QSize(100, 100)
+        return QSize(int(min(width * 0.8, 500)), 103 if name else 85)
+
+    def download(self, download_id: UUID) -> None:
+        """Requests content of attachments with ```download_id```."""
+        if download_id in self.downloads or download_id not in self.pending:
+            return
+        path = download_path(self.pending[download_id][0].header)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.unavailable.discard(download_id)
+        self.downloads[download_id] = (FileSink(path), 0)
+        self.p.request_download(download_id)
+
+    def load_visible(self) -> None:
+        """Downloads attachments that are scrolled into view
+        unless they are bigger than ```auto_download```."""
+        if not self.auto_download:
+            return
+        for dl_id, waiting in list(self.pending.items()):
+            header = waiting[0].header
+            if (dl_id in self.downloads or dl_id in self.unavailable
+                    or header['message_length'] > self.auto_download):
+                continue
+            if any(self.p.chat_view.is_visible(item) for item in waiting):
+                self.download(dl_id)
+
+    def receive_chunk(
+            self, download_id: UUID, offset: int, total: int, chunk: bytes
     ) -> None:
-        timestamp, name, data = self._get_data(header, msg, own)
+        """Writes part of downloaded content and replaces placeholders
+        once it is complete. ```total``` of -1 means there is no content."""
+        if download_id not in self.downloads:
+            return
+        sink, received = self.downloads.pop(download_id)
+        waiting = self.pending.get(download_id, [])
+        if total < 0 or offset != received:
+            sink.abort()
+            self.unavailable.add(download_id)
+            for placeholder in self._placeholders(waiting):
+                placeholder.set_unavailable()
+            return
+
+        sink.write(chunk)
+        received += len(chunk)
+        if received < total:
+            self.downloads[download_id] = (sink, received)
+            for placeholder in self._placeholders(waiting):
+                placeholder.set_progress(received)
+            return
+
+        sink.close()
+        for item in self.pending.pop(download_id):
+            item.path = sink.path
+            if item in self.model.items:
+                self.model.refresh(item)
+
+    def clear(self) -> None:
+        for sink, _ in self.downloads.values():
+            sink.abort()
+        self.downloads.clear()
+        self.pending.clear()
+        self.unavailable.clear()
+        self.model.clear()
+
+    def _placeholders(
+            self, items: list[MessageItem]
+    ) -> Iterator[AttachmentPlaceholder]:
+        # Only messages on screen have widgets
+        for item in items:
+            widget = self.p.chat_view.widget(item)
+            if isinstance(widget, AttachmentPlaceholder):
+                yield widget
+
+    def _render_pending(self, item: MessageItem) -> QWidget:
+        header = item.header
+        timestamp, name, preview = self._get_data(header, item.msg, item.own)
+        placeholder = AttachmentPlaceholder(
+            header.get('basename', ''), header['message_length'],
+            name, self.p, timestamp,
+            QImage.fromData(preview) if header.get('preview') else None
+        )
+
+        dl_id = header['download_id'] #type: ignore
+        placeholder.clicked.connect(lambda: self.download(dl_id))
+        if dl_id in self.downloads:
+            placeholder.set_progress(self.downloads[dl_id][1])
+        elif dl_id in self.unavailable:
+            placeholder.set_unavailable()
+        return placeholder
+
+    def _render_file(self, item: MessageItem) -> QWidget:
+        timestamp, name, _ = self._get_data(item.header, item.msg, item.own)
+        path = item.path
+        match item.header['message_type']:
+            case MsgType.IMAGE:
+                message = SingleImage(self.p, path, name, timestamp)
+            case MsgType.VIDEO:
+                message = VideoWidget(path, self.p, name, timestamp)
+            case _:
+                message = DocAttachment(path, name, False, self.p, timestamp)
+        if item.own:
+            message.setFocusProxy(self.p.send_field)
+        return message
+
+    def _render_text_msg(self, item: MessageItem) -> QWidget:
+        timestamp, name, data = self._get_data(item.header, item.msg, item.own)
         message = TextBubble(self.p, data.decode(), name, timestamp)
 
-        # chat_area and send_field are parts of ChatWidget which
+        # chat_view and send_field are parts of ChatWidget which
         # I cannot import as a type due to the way circular imports
         # are handled in python
-        message.chat = self.p.chat_area
+        message.chat = self.p.chat_view
         message.sel = self.p.send_field
 
-        self._insert_message(message, pos, own)
-
-    def _render_img_msg(
-            self, header: Tags, msg: bytes, pos: int, own: bool
-    ) -> None:
-        timestamp, name, data = self._get_data(header, msg, own)
-
-        path = None
-        _, ext = os.path.splitext(header.get('basename', ''))
-        if ext == ".gif":
-            path = save_file(data, header.get('basename', ''))
-
-        message = SingleImage(self.p,
-                              path if path else QImage.fromData(data),
-                              name, timestamp)
-
-        self._insert_message(message, pos, own)
+        return message
 
-    def _render_vid_msg(
-            self, header: Tags, msg: bytes, pos: int, own: bool
-    ) -> None:
-        timestamp, name, data = self._get_data(header, msg, own)
-        path = save_file(data, header.get('basename', ''))
-        message = VideoWidget(path, self.p, name, timestamp)
-        self._insert_message(message, pos, own)
-
-    def _render_doc_msg(
-            self, header: Tags, msg: bytes, pos: int, own: bool
-    ) -> None:
-        timestamp, name, data = self._get_data(header, msg, own)
-        path = save_file(data, header.get('basename', ''))
-        message = DocAttachment(path, name, False, self.p, timestamp)
-        self._insert_message(message, pos, own)
-
-    def _render_unknown_msg(
-            self, header: Tags, msg: bytes, pos: int, own: bool
-    ) -> None:
-        timestamp, name, _ = self._get_data(header, msg, own)
-        message = TextBubble(self.p, "This message cannot be displayed",
-                             name, timestamp, unknown = True)
-        self._insert_message(message, pos, own)
-
-    def _insert_message(
-            self, message: QWidget, position: int, own: bool
-    ) -> None:
-        self.layout.insertWidget(position, message,
-                                 alignment=(
-                                     Qt.AlignmentFlag.AlignRight if own 
-                                     else Qt.AlignmentFlag.AlignLeft
-                                 )
-                             )
+    def _render_unknown_msg(self, item: MessageItem) -> QWidget:
+        timestamp, name, _ = self._get_data(item.header, item.msg, item.own)
+        return TextBubble(self.p, "This message cannot be displayed",
+                          name, timestamp, unknown = True)
 
     def _get_data(
             self, header: Tags, msg: bytes, own: bool
@@ -106,11 +228,12 @@ class MessageRenderer():
         
         return timestamp, name, data
 
-def save_file(data: bytes, basename: str = "") -> str:
-    if not basename:
-        basename = generate_name()
-    documents_dir.mkdir(parents=True, exist_ok=True)
-    with open(f"{documents_dir}/{basename}", "wb") as f:
-        f.write(data)
-    
-    return f"{documents_dir}/{basename}"
+def download_path(header: Tags) -> str:
+    """Path of downloaded content of an attachment. Every download id
+    has its own directory so attachments with the same name don't clash."""
+    dl_id = header['download_id'].hex #type: ignore
+    basename = os.path.basename(header.get('basename', ''))
+    if not os.path.splitext(basename)[0].strip('.'):
+        # Static images are sent with extension only
+        basename = f"{dl_id}{basename}"
+    return f"{documents_dir}/{dl_id}/{basename}"
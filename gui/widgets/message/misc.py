@@ -1,10 +1,9 @@
 from enum import Enum
-from typing import TypedDict
+from typing import Iterable, Iterator, TypedDict
 from datetime import datetime
 from uuid import UUID
 
-from Crypto.PublicKey import RSA
-from Crypto.Cipher import PKCS1_OAEP
+from ..utils.encryption import get_cipher
 
 class MsgType(Enum):
     TEXT = b'TXT'
@@ -38,10 +37,43 @@ class VMediaTags(FileTags):
     """File Tags with boolean value of whether message is a preview or not."""
     preview: bool
 
+class HistoryEntry(TypedDict):
+    """Message from chatroom's history with its position in it.
+    ```id``` and ```timestamp_us``` make a cursor to fetch the next page."""
+    id: int
+    timestamp_us: int
+    tags: Tags
+    data: bytes
+
 def msg_encrypt(data: bytes, pubkey: bytes) -> bytes:
-    public_key = RSA.import_key(pubkey)
-    cipher = PKCS1_OAEP.new(public_key)
-    return cipher.encrypt(data)
+    return get_cipher(pubkey).encrypt(data)
+
+def coalesce_frames(
+        blocks: Iterable[bytes | memoryview], high_water: int
+) -> Iterator[bytearray]:
+    """Prefixes each block with its 4-byte length and joins frames into
+    buffers of at least ```high_water``` bytes (the last one may be smaller),
+    so a whole message header goes out in a single write.
+
+    Every yielded buffer is a new object and is never modified afterwards,
+    so it is safe to hand it over to a transport without copying.
+    """
+    buf = bytearray()
+    for block in blocks:
+        buf += len(block).to_bytes(4, "big")
+        buf += block
+        if len(buf) >= high_water:
+            yield buf
+            buf = bytearray()
+    if buf:
+        yield buf
+
+# Latest supported version of message header format:
+#   0 - header tags are sent one by one and encrypted with RSA
+#   1 - header is one binary struct encrypted with message's AES key
+HEADER_VERSION = 1
+# First block of a message with binary header
+HEADER_V1 = b'<!H1>'
 
 FILELIKE = (MsgType.DOCUMENT, MsgType.IMAGE, MsgType.VIDEO)
 PICTURE_EXT = (
@@ -0,0 +1,102 @@
+import asyncio
+from asyncio.streams import StreamWriter
+from enum import Enum
+
+from . import AsyncSender
+
+
+class SlowConsumer(Enum):
+    """What to do with a message when recipient's outbox is full."""
+    DROP = "drop"
+    DISCONNECT = "disconnect"
+
+class Outbox():
+    """Queue of outgoing messages of a single connection.
+
+    Messages are written to the socket by a dedicated task, so
+    a recipient on a slow link delays only its own messages.
+    Once either ```max_bytes``` or ```max_messages``` is exceeded
+    new messages are handled according to ```policy```.
+    """
+    def __init__(
+            self, sock: StreamWriter, sender: AsyncSender,
+            max_bytes: int, max_messages: int,
+            policy: SlowConsumer = SlowConsumer.DROP
+    ) -> None:
+
+        self.sock = sock
+        self.sender = sender
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.policy = policy
+        self.queued_bytes = 0
+        self.dropped = 0
+        self.closed = False
+        self._queue: asyncio.Queue[
+                tuple[list[bytes | memoryview], int]
+                ] = asyncio.Queue()
+        # Set every time a message leaves the queue
+        self._sent = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    def put(
+            self, blocks: list[bytes | memoryview], force: bool = False
+    ) -> bool:
+        """Queues blocks of one message.
+
+        :param force: queue the message even if the outbox is full,
+        e.g. reply to a command which the client waits for.
+        :return: ```True``` if message was queued else ```False```
+        :rtype: ```bool```
+        """
+        if self.closed:
+            return False
+
+        size = sum(len(b) for b in blocks)
+        # Message is always accepted into an empty queue, otherwise
+        # a message bigger than max_bytes could never be delivered
+        if not force and not self._queue.empty() and (
+                self._queue.qsize() >= self.max_messages
+                or self.queued_bytes + size > self.max_bytes
+                ):
+            if self.policy == SlowConsumer.DISCONNECT:
+                self.close()
+                self.sock.close()
+            else:
+                self.dropped += 1
+            return False
+
+        self.queued_bytes += size
+        self._queue.put_nowait((blocks, size))
+        return True
+
+    async def wait_for_room(self, size: int) -> None:
+        """Waits until ```size``` bytes fit into half of ```max_bytes```
+        and less than half of ```max_messages``` are queued.
+
+        Bulk transfers wait for it before every ```put```, so they
+        are paced by the recipient and leave room for other messages.
+        """
+        while not self.closed and self.queued_bytes and (
+                self.queued_bytes + size > self.max_bytes // 2
+                or self._queue.qsize() >= self.max_messages // 2):
+            self._sent.clear()
+            await self._sent.wait()
+
+    def close(self) -> None:
+        self.closed = True
+        self._task.cancel()
+        self._sent.set()
+
+    async def _run(self) -> None:
+        while True:
+            blocks, size = await self._queue.get()
+            try:
+                await self.sender.send_blocks(blocks, self.sock)
+            except ConnectionError:
+                # Reader side of the connection handles the cleanup
+                self.closed = True
+                return
+            finally:
+                self.queued_bytes -= size
+                self._sent.set()
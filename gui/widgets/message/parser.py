@@ -1,11 +1,13 @@
 import os
-from datetime import datetime
+import struct
+from datetime import UTC, datetime
 from uuid import UUID
 
 from Crypto.Cipher.PKCS1_OAEP import PKCS1OAEP_Cipher
 
 from . import (
     Tags,
+    HistoryEntry,
     MsgType,
     msg_encrypt,
     FileTags,
@@ -63,23 +65,9 @@ class HeaderParser():
 
         basename = self._decrypt(tags[3]).decode()
         dl_id = UUID(bytes=self._decrypt(tags[-2]))
-
-        _, ext = os.path.splitext(basename)
-        if msg_type != MsgType.VIDEO and ext not in PICTURE_EXT:
-            return FileTags(**{
-                **base_tags,
-                "basename": basename,
-                "download_id": dl_id,
-            })
-
         preview = tags[4] != b'0'
 
-        return VMediaTags(**{
-            **base_tags,
-            "basename": basename,
-            "preview": preview,
-            "download_id": dl_id,
-        })
+        return _file_tags(base_tags, basename, preview, dl_id)
 
     def _decrypt(self, data) -> bytes:
         return self._cipher.decrypt(data)
@@ -121,3 +109,134 @@ def generate_header(tags: Tags, public_key: bytes) -> list[bytes]:
 
     return tag_list
 
+
+def _file_tags(
+        base_tags: dict, basename: str, preview: bool, dl_id: UUID
+) -> FileTags | VMediaTags:
+    _, ext = os.path.splitext(basename)
+    if base_tags["message_type"] != MsgType.VIDEO and ext not in PICTURE_EXT:
+        return FileTags(**{
+            **base_tags,
+            "basename": basename,
+            "download_id": dl_id,
+        })
+
+    return VMediaTags(**{
+        **base_tags,
+        "basename": basename,
+        "preview": preview,
+        "download_id": dl_id,
+    })
+
+# Message type, message length, chatroom id, POSIX timestamp,
+# preview flag, download id and length of basename that follows the struct
+_HEADER_V1 = struct.Struct(">3sQ16sd?16sH")
+
+def pack_header(tags: Tags) -> bytes:
+    """
+    Packs tags into a binary header (version 1).
+
+    Unlike ```generate_header``` nothing is encrypted here, the result
+    should be encrypted with AES key of the message as a whole.
+    Fields that are not present in ```tags``` are zeroed.
+
+    Args:
+        tags: ```Tags```
+            TypedDict of type Tags.
+    """
+    basename = tags.get("basename", "").encode()
+    timestamp = tags.get("timestamp")
+    dl_id = tags.get("download_id", UUID(int=0))
+
+    return _HEADER_V1.pack(
+        tags["message_type"].value,
+        tags["message_length"],
+        tags["chatroom_id"].bytes,
+        timestamp.timestamp() if timestamp else 0.0,
+        tags.get("preview", False),
+        dl_id.bytes,
+        len(basename),
+    ) + basename
+
+def unpack_header(header: bytes) -> Tags:
+    """
+    Unpacks binary header (version 1) produced by ```pack_header```.
+
+    Args:
+        header: ```bytes```
+            Decrypted header.
+    """
+    (typ, msg_len, room_id, timestamp,
+     preview, dl_id, name_len) = _HEADER_V1.unpack_from(header)
+    basename = bytes(
+        header[_HEADER_V1.size:_HEADER_V1.size + name_len]
+    ).decode()
+
+    try:
+        msg_type = MsgType(typ)
+    except ValueError:
+        msg_type = MsgType.UNKNOWN
+
+    base_tags = {
+        "message_type": msg_type,
+        "message_length": msg_len,
+        "chatroom_id": UUID(bytes=room_id),
+        "timestamp": datetime.fromtimestamp(
+            timestamp, UTC
+        ).astimezone(),
+    }
+
+    if msg_type not in FILELIKE:
+        return Tags(**base_tags)
+
+    return _file_tags(base_tags, basename, preview, UUID(bytes=dl_id))
+
+# Message id, timestamp in microseconds, length of header
+# and length of data that follow the struct
+_HISTORY_ENTRY = struct.Struct(">QqII")
+
+def pack_history(entries: list[HistoryEntry]) -> bytes:
+    """
+    Packs page of chatroom's history into one buffer, so it is sent
+    as a single message. Tags of every entry are packed with ```pack_header```.
+
+    Args:
+        entries: ```list[HistoryEntry]```
+            Messages in chronological order.
+    """
+    parts = []
+    for entry in entries:
+        header = pack_header(entry["tags"])
+        parts.append(_HISTORY_ENTRY.pack(
+            entry["id"], entry["timestamp_us"], len(header), len(entry["data"])
+        ))
+        parts.append(header)
+        parts.append(entry["data"])
+
+    return b''.join(parts)
+
+def unpack_history(data: bytes) -> list[HistoryEntry]:
+    """
+    Unpacks page of chatroom's history produced by ```pack_history```.
+
+    Args:
+        data: ```bytes```
+            Decrypted page.
+    """
+    entries = []
+    view = memoryview(data)
+    pos = 0
+    while pos < len(view):
+        msg_id, ts, header_len, data_len = _HISTORY_ENTRY.unpack_from(view, pos)
+        pos += _HISTORY_ENTRY.size
+        tags = unpack_header(view[pos:pos + header_len])
+        pos += header_len
+        entries.append(HistoryEntry(
+            id=msg_id,
+            timestamp_us=ts,
+            tags=tags,
+            data=bytes(view[pos:pos + data_len]),
+        ))
+        pos += data_len
+
+    return entries
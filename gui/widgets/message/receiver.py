@@ -1,21 +1,203 @@
+import asyncio
 from asyncio.streams import StreamReader
+import os
 from ssl import SSLSocket
 from datetime import UTC, datetime
-from uuid import uuid4
+from typing import Protocol
+from uuid import UUID, uuid4
 
+from Crypto.Cipher import AES
 from Crypto.Cipher.PKCS1_OAEP import PKCS1OAEP_Cipher
 
-from ..utils.encryption import unpack_data, decrypt_aes
-from . import ChunkSize, HeaderParser, Tags, MsgType, FILELIKE
+from ..utils.encryption import decrypt_aes
+from . import (
+    ChunkSize,
+    HeaderParser,
+    Tags,
+    MsgType,
+    unpack_header,
+    FILELIKE,
+    HEADER_V1,
+)
 
 
-def decrypt_message(cipher: PKCS1OAEP_Cipher, data: bytes) -> bytes:
-    enc_data, enc_aes, _ = unpack_data(data)
+def split_message(
+        data: bytes | bytearray
+) -> tuple[memoryview, memoryview]:
+    """Splits output of ```pack_data``` into ciphertext and wrapped
+    AES key. Same as ```unpack_data``` but parts are views instead of
+    copies and public key is not imported."""
+    # Public key is PEM so it can't contain separator
+    # and splitting starts from the right
+    key_end = data.rfind(b'<SEP>')
+    text_end = data.rfind(b'<SEP>', 0, key_end)
+    if text_end == -1:
+        raise ValueError("Malformed message")
+    view = memoryview(data)
+    return view[:text_end], view[text_end + 5:key_end]
+
+def wrapped_key(block: bytes) -> bytes:
+    """Returns wrapped AES key from output of ```pack_key```."""
+    # Public key is PEM so it can't contain separator
+    enc_aes, _ = block.removeprefix(b'<SEP>').rsplit(b'<SEP>', 1)
+    return enc_aes
+
+def decrypt_message(cipher: PKCS1OAEP_Cipher, data: bytes | bytearray) -> bytes:
+    text, enc_aes = split_message(data)
     aes = cipher.decrypt(enc_aes)
-    msg = decrypt_aes(enc_data, aes)
+    msg = decrypt_aes(text, aes) #type: ignore
 
     return msg
 
+class CryptoExecutor(Protocol):
+    """Runs RSA operations with receiver's private key elsewhere
+    (e.g. in a process pool) instead of the event loop."""
+    async def rsa_decrypt(self, data: bytes) -> bytes: ...
+    async def parse_header(self, header: bytes) -> Tags: ...
+
+class MessageSink(Protocol):
+    """Destination for content of a streamed message.
+
+    Data is written before the message is authenticated, so
+    everything written must be discarded if ```abort``` is called.
+    Calling ```abort``` after the sink is closed or aborted does nothing.
+    """
+    def write(self, data: bytes) -> None: ...
+    def close(self) -> None: ...
+    def abort(self) -> None: ...
+
+class BlobSink(MessageSink, Protocol):
+    """```MessageSink``` which knows ```download_id``` of the content
+    once it is closed."""
+    download_id: UUID
+
+class BlobStorage(Protocol):
+    """Storage for content of file-like messages (e.g. ```BlobStore```
+    of the server), so it is not kept in memory."""
+    def sink(self) -> BlobSink: ...
+
+class BufferSink():
+    """Collects message content in memory."""
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+
+    def write(self, data: bytes) -> None:
+        self.buffer += data
+
+    def close(self) -> None:
+        pass
+
+    def abort(self) -> None:
+        self.buffer.clear()
+
+class FileSink():
+    """Writes message content into a temporary file next to ```path```
+    and moves it in place only after the message is authenticated."""
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._tmp = f"{path}.part"
+        self._f = open(self._tmp, "wb")
+
+    def write(self, data: bytes) -> None:
+        self._f.write(data)
+
+    def close(self) -> None:
+        self._f.close()
+        os.replace(self._tmp, self.path)
+
+    def abort(self) -> None:
+        if self._f.closed:
+            return
+        self._f.close()
+        os.remove(self._tmp)
+
+class NamedSink():
+    """Passes content to ```sink``` without sender's name and separator
+    it starts with. The name is kept in ```name```."""
+    # Longer prefix without separator is not a name
+    MAX_NAME = 1024
+
+    def __init__(self, sink: MessageSink) -> None:
+        self.sink = sink
+        self.name = bytearray()
+        self._found = False
+
+    def write(self, data: bytes) -> None:
+        if not self._found:
+            self.name += data
+            i = self.name.find(b'<SEP>')
+            if i == -1:
+                if len(self.name) > self.MAX_NAME:
+                    self.sink.abort()
+                    raise ValueError("Malformed message")
+                return
+            self._found = True
+            data = bytes(self.name[i + 5:])
+            del self.name[i:]
+            if not data:
+                return
+        self.sink.write(data)
+
+    def close(self) -> None:
+        if not self._found:
+            self.sink.abort()
+            raise ValueError("Malformed message")
+        self.sink.close()
+
+    def abort(self) -> None:
+        self.sink.abort()
+
+class StreamDecryptor():
+    """Decrypts content of a message sent after ```<!STREAM>``` separator
+    block by block.
+
+    First block is the wrapped AES key (output of ```pack_key```),
+    unless ```key``` is already known (binary header messages),
+    the rest is nonce, ciphertext and tag split into blocks of any size.
+    Last 16 bytes are held back until the end as they may be the tag.
+    """
+    def __init__(
+            self, cipher: PKCS1OAEP_Cipher, sink: MessageSink,
+            key: bytes = b''
+    ) -> None:
+        self.cipher = cipher
+        self.sink = sink
+        self._key = key
+        self._aes = None
+        self._pending = bytearray()
+
+    def feed(self, block: bytes) -> None:
+        if not self._key:
+            self._key = self.cipher.decrypt(wrapped_key(block))
+            return
+
+        self._pending += block
+        if self._aes is None:
+            if len(self._pending) < 16:
+                return
+            nonce = bytes(self._pending[:16])
+            del self._pending[:16]
+            self._aes = AES.new(self._key, AES.MODE_GCM, nonce=nonce)
+
+        n = len(self._pending) - 16
+        if n > 0:
+            self.sink.write(self._aes.decrypt(self._pending[:n]))
+            del self._pending[:n]
+
+    def finish(self) -> None:
+        """Verifies the tag and closes the sink.
+
+        :raises ValueError: if message is incomplete or was tampered with.
+        """
+        try:
+            if self._aes is None or len(self._pending) != 16:
+                raise ValueError("Incomplete message")
+            self._aes.verify(bytes(self._pending))
+        except ValueError:
+            self.sink.abort()
+            raise
+        self.sink.close()
+
 class Receiver():
     def __init__(self, socket: SSLSocket, cipher: PKCS1OAEP_Cipher,
                  chunk_size: ChunkSize = ChunkSize.K64) -> None:
@@ -23,103 +205,260 @@ class Receiver():
         self.s = socket
         self.cipher = cipher
         self.chunk_size = chunk_size.value
+        # Buffers reused for every frame
+        self._prefix = bytearray(4)
+        self._buf = bytearray(self.chunk_size)
 
     def receive_message(self) -> tuple[Tags, bytes]:
         is_header = True
         chunks = []
         header = b''
+        body = bytearray()
 
         while True:
-            length_bytes = self.s.recv(4)
-            length = int.from_bytes(length_bytes, "big")
-
-            # For some reason client buffer limit is 16KB and I can't
-            # change it, so I have to rely on this workaround that
-            # slows down the receiving 😢
-            bytes_read = 0
-            chunk = b''
-            while bytes_read < length:
-                dat = self.s.recv(length - bytes_read)
-                chunk += dat
-                bytes_read += len(dat)
-
-            if chunk:
-                if chunk == b'MSGEND':
-                    break
+            chunk = self._recv_frame()
+            if chunk == b'MSGEND':
+                break
 
+            if is_header and not chunks and chunk == HEADER_V1:
+                return self._receive_v1()
+
+            if is_header:
                 # Separate header tags from message content
                 if chunk == b'<!DATA>':
                     header = b''.join(chunks)
                     chunks.clear()
                     is_header = False
                     continue
-
-                if is_header:
-                    chunks.append(length_bytes)
-                chunks.append(chunk)
+                chunks.append(len(chunk).to_bytes(4, "big"))
+                chunks.append(bytes(chunk))
             else:
-                raise RuntimeError("Socket connection broken")
+                body += chunk
 
         tags = HeaderParser(header, self.cipher).tags
 
-        encrypted = b''.join(chunks)
-        data = decrypt_message(self.cipher, encrypted)
+        data = decrypt_message(self.cipher, body)
         return tags, data
 
+    def _receive_v1(self) -> tuple[Tags, bytes]:
+        # Wrapped AES key, encrypted header, then content until MSGEND
+        key = self.cipher.decrypt(self._recv_frame())
+        tags = unpack_header(decrypt_aes(self._recv_frame(), key)) #type: ignore
+        body = bytearray()
+        while (chunk := self._recv_frame()) != b'MSGEND':
+            body += chunk
+
+        data = decrypt_aes(memoryview(body), key) #type: ignore
+        return tags, data
+
+    def _recv_frame(self) -> memoryview:
+        length_bytes = self._recv_exactly(self._prefix, 4)
+        length = int.from_bytes(length_bytes, "big")
+        if length > len(self._buf):
+            self._buf = bytearray(length)
+        chunk = self._recv_exactly(self._buf, length)
+        if not chunk:
+            raise RuntimeError("Socket connection broken")
+        return chunk
+
+    def _recv_exactly(self, buf: bytearray, n: int) -> memoryview:
+        """Fills first ```n``` bytes of ```buf``` from the socket.
+        TLS socket returns at most one record (16KB) per call, so
+        data is read straight into the buffer instead of concatenating."""
+        view = memoryview(buf)[:n]
+        pos = 0
+        while pos < n:
+            received = self.s.recv_into(view[pos:], n - pos)
+            if not received:
+                raise RuntimeError("Socket connection broken")
+            pos += received
+        return view
+
 class AsyncReceiver():
     def __init__(self, socket: StreamReader, cipher: PKCS1OAEP_Cipher,
-                 chunk_size: ChunkSize = ChunkSize.K64) -> None:
+                 chunk_size: ChunkSize = ChunkSize.K64,
+                 crypto: CryptoExecutor | None = None,
+                 blobs: BlobStorage | None = None) -> None:
 
         self.s = socket
         self.cipher = cipher
         self.chunk_size = chunk_size.value
+        # If set, private key operations are offloaded to it
+        self.crypto = crypto
+        # If set, content of file-like messages is put there instead
+        # of being returned, returned data is only sender's name and
+        # separator while "download_id" tag points to the content
+        self.blobs = blobs
+
+    async def receive_message(
+            self, sink: MessageSink | None = None
+    ) -> tuple[Tags, bytes]:
+        """Receives one message.
 
-    async def receive_message(self) -> tuple[Tags, bytes]:
+        Content sent after ```<!STREAM>``` separator is decrypted while it
+        arrives, otherwise it is buffered and decrypted at the end.
+
+        :param sink: destination for message content, if given content
+        is written into it and returned data is empty. Sink is written
+        in a thread as it may do blocking I/O.
+        :type sink: ```MessageSink | None```
+        """
         is_header = True
+        streaming = False
+        decryptor = None
+        # Content decrypted from the stream, but not yet written to sink
+        staged = BufferSink()
+        blob = None
         chunks = []
         header = b''
 
-        while True:
-            length_bytes = await self.s.readexactly(4)
-            length = int.from_bytes(length_bytes, "big")
-            chunk = await self.s.readexactly(min(length, self.chunk_size))
+        try:
+            while True:
+                length_bytes = await self.s.readexactly(4)
+                length = int.from_bytes(length_bytes, "big")
+                chunk = await self.s.readexactly(min(length, self.chunk_size))
 
-            if chunk:
-                if chunk == b'MSGEND':
-                    break
+                if chunk:
+                    if chunk == b'MSGEND':
+                        break
 
-                # Separate header tags from message content
-                if chunk == b'<!DATA>':
-                    try:
-                        msg_type = MsgType(chunks[1])
-                        if msg_type in FILELIKE:
-                            # WARN: Should be checked whether id 
-                            # already exists in blob storage
-                            dl_id = self.cipher.encrypt(uuid4().bytes)
-                            chunks.append(len(dl_id).to_bytes(4, "big"))
-                            chunks.append(dl_id)
-                    except ValueError:
-                        pass
-                    # Generate UTC timestamp on the serverside
-                    timestamp = self.cipher.encrypt(str(
-                            datetime.now().astimezone(UTC).timestamp()
-                            ).encode())
-                    chunks.append(len(timestamp).to_bytes(4, "big"))
-                    chunks.append(timestamp)
+                    if is_header and not chunks and chunk == HEADER_V1:
+                        return await self._receive_v1(sink)
 
-                    header = b''.join(chunks)
-                    chunks.clear()
-                    is_header = False
-                    continue
+                    # Separate header tags from message content
+                    if is_header and chunk in (b'<!DATA>', b'<!STREAM>'):
+                        try:
+                            msg_type = MsgType(chunks[1])
+                            if msg_type in FILELIKE:
+                                if sink is None and self.blobs is not None:
+                                    blob = NamedSink(await asyncio.to_thread(
+                                            self.blobs.sink))
+                                    sink = blob
+                                # Placeholder until content is stored
+                                dl_id = self.cipher.encrypt(uuid4().bytes)
+                                chunks.append(len(dl_id).to_bytes(4, "big"))
+                                chunks.append(dl_id)
+                        except ValueError:
+                            pass
+                        # Generate UTC timestamp on the serverside
+                        timestamp = self.cipher.encrypt(str(
+                                datetime.now().astimezone(UTC).timestamp()
+                                ).encode())
+                        chunks.append(len(timestamp).to_bytes(4, "big"))
+                        chunks.append(timestamp)
+
+                        header = b''.join(chunks)
+                        chunks.clear()
+                        is_header = False
+                        streaming = chunk == b'<!STREAM>'
+                        continue
 
-                if is_header:
-                    chunks.append(length_bytes)
-                chunks.append(chunk)
+                    if is_header:
+                        chunks.append(length_bytes)
+                        chunks.append(chunk)
+                    elif decryptor is not None:
+                        decryptor.feed(chunk)
+                        if sink is not None:
+                            await self._write(sink, staged)
+                    elif streaming:
+                        # First block of a stream is the wrapped key
+                        key = await self._rsa_decrypt(wrapped_key(chunk))
+                        decryptor = StreamDecryptor(self.cipher, staged, key)
+                    else:
+                        chunks.append(chunk)
+                else:
+                    raise RuntimeError("Socket connection broken")
+
+            if self.crypto is not None:
+                tags = await self.crypto.parse_header(header)
             else:
-                raise RuntimeError("Socket connection broken")
+                tags = HeaderParser(header, self.cipher).tags
 
-        tags = HeaderParser(header, self.cipher).tags
+            if decryptor is not None:
+                decryptor.finish()
+                if sink is None:
+                    return tags, bytes(staged.buffer)
+                await asyncio.to_thread(sink.close)
+                return self._stored(tags, blob)
 
-        encrypted = b''.join(chunks)
-        data = decrypt_message(self.cipher, encrypted)
-        return tags, data
+            encrypted = b''.join(chunks)
+            chunks.clear()
+            text, enc_aes = split_message(encrypted)
+            data = decrypt_aes(text, await self._rsa_decrypt(enc_aes)) #type: ignore
+            if sink is not None:
+                await asyncio.to_thread(sink.write, data)
+                await asyncio.to_thread(sink.close)
+                return self._stored(tags, blob)
+            return tags, data
+        except BaseException:
+            # Content of an aborted message isn't left in the sink
+            if sink is not None:
+                sink.abort()
+            raise
+
+    def _stored(
+            self, tags: Tags, blob: NamedSink | None
+    ) -> tuple[Tags, bytes]:
+        """Return value for a message which content was written to a sink."""
+        if blob is None:
+            return tags, b''
+        tags["download_id"] = blob.sink.download_id #type: ignore
+        return tags, bytes(blob.name) + b'<SEP>'
+
+    async def _receive_v1(
+            self, sink: MessageSink | None
+    ) -> tuple[Tags, bytes]:
+        # Wrapped AES key, encrypted header, then content until MSGEND
+        key = await self._rsa_decrypt(await self._read_block())
+        tags = unpack_header(decrypt_aes(await self._read_block(), key))
+
+        # Generate timestamp and download id on the serverside
+        tags["timestamp"] = datetime.now().astimezone()
+        blob = None
+        if tags["message_type"] in FILELIKE:
+            if sink is None and self.blobs is not None:
+                blob = NamedSink(await asyncio.to_thread(self.blobs.sink))
+                sink = blob
+            else:
+                tags["download_id"] = uuid4() #type: ignore
+
+        staged = BufferSink()
+        decryptor = StreamDecryptor(self.cipher, staged, key)
+        try:
+            while (chunk := await self._read_block()) != b'MSGEND':
+                decryptor.feed(chunk)
+                if sink is not None:
+                    await self._write(sink, staged)
+            decryptor.finish()
+            if sink is not None:
+                await asyncio.to_thread(sink.close)
+        except BaseException:
+            if sink is not None:
+                sink.abort()
+            raise
+
+        if sink is None:
+            return tags, bytes(staged.buffer)
+        return self._stored(tags, blob)
+
+    async def _write(self, sink: MessageSink, staged: BufferSink) -> None:
+        """Moves content decrypted so far from ```staged``` to ```sink```.
+        It is done in a thread, so disk I/O of the sink doesn't
+        block the event loop."""
+        if staged.buffer:
+            data = bytes(staged.buffer)
+            staged.buffer.clear()
+            await asyncio.to_thread(sink.write, data)
+
+    async def _read_block(self) -> bytes:
+        length_bytes = await self.s.readexactly(4)
+        length = int.from_bytes(length_bytes, "big")
+        chunk = await self.s.readexactly(min(length, self.chunk_size))
+        if not chunk:
+            raise RuntimeError("Socket connection broken")
+        return chunk
+
+    async def _rsa_decrypt(self, data: bytes | memoryview) -> bytes:
+        if self.crypto is not None:
+            return await self.crypto.rsa_decrypt(bytes(data))
+        return self.cipher.decrypt(data)
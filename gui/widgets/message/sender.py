@@ -1,15 +1,27 @@
 from asyncio.streams import StreamWriter
+from datetime import UTC, datetime
+import itertools
 import os
 from ssl import SSLSocket
+from threading import Lock
+from typing import Iterable, Iterator
 from uuid import UUID
 
-from ..utils.encryption import pack_data, encrypt_aes
+from Crypto.Random import get_random_bytes
+
+from ..utils.encryption import (
+    pack_data, pack_key, encrypt_aes, encrypt_aes_stream, get_cipher,
+)
 from . import (
     ChunkSize,
     MsgType,
     Tags,
+    VMediaTags,
     generate_header,
+    pack_header,
     msg_encrypt,
+    coalesce_frames,
+    HEADER_V1,
     FILELIKE,
     PICTURE_EXT,
 )
@@ -18,51 +30,139 @@ from . import (
 class Sender():
     def __init__(
             self, socket: SSLSocket, name: str, server_pubkey: bytes,
-            chunk_size: ChunkSize = ChunkSize.K64
+            chunk_size: ChunkSize = ChunkSize.K64, header_version: int = 0
     ) -> None:
 
         self.s = socket
         self.chunk_size = chunk_size.value
         self._name = name.encode()
         self.server = server_pubkey
+        # Header version agreed with the server during sign in
+        self.header_version = header_version
+        # Messages may be sent from several threads,
+        # their frames must not interleave
+        self._lock = Lock()
 
     def send_message(
             self, msg: bytes, typ: MsgType, pubkey: bytes,
             chatroom_id: UUID, basename: str = ""
     ) -> None:
 
-        self._send_block(typ.value)
-        self._send_block(len(msg).to_bytes(4, "big"))
-        self._send_block(msg_encrypt(chatroom_id.bytes, self.server))
+        if self.header_version >= 1:
+            self._send_v1(msg, typ, pubkey, chatroom_id, basename)
+            return
+
+        blocks = self._header_v0(typ, len(msg), chatroom_id, basename)
 
+        sz = self.chunk_size
         if typ in FILELIKE:
-            print(basename)
-            self._send_block(msg_encrypt(basename.encode(), self.server))
+            # Files are sent with wrapped key first, so receiver
+            # can decrypt them while they arrive
+            blocks.append(b'<!STREAM>')
+            text, key = encrypt_aes(self._name + b'<SEP>' + msg)
+            blocks.append(pack_key(key, pubkey))
+            data = memoryview(text)
+        else:
+            # Separator that differentiates header tags from actual data
+            blocks.append(b'<!DATA>')
+            data = memoryview(
+                    pack_data(encrypt_aes(self._name + b'<SEP>' + msg), pubkey)
+                    )
+        for i in range(0, len(data), sz):
+            blocks.append(data[i:i + sz])
+
+        # END tag to tell receiver to stop reading stream
+        blocks.append(b'MSGEND')
+
+        self._send_blocks(blocks)
+
+    def send_file(
+            self, path: str, typ: MsgType, pubkey: bytes,
+            chatroom_id: UUID, basename: str
+    ) -> None:
+        """Same as ```send_message``` with content of the file at ```path```,
+        but the file is read, encrypted and sent by ```chunk_size``` pieces,
+        so memory use doesn't depend on the size of the file."""
+        size = os.path.getsize(path)
+        key = get_random_bytes(32)
+
+        if self.header_version >= 1:
+            tags = self._tags_v1(typ, size, chatroom_id, basename)
+            head = [
+                HEADER_V1,
+                get_cipher(pubkey).encrypt(key),
+                encrypt_aes(pack_header(tags), key)[0],
+            ]
+        else:
+            head = self._header_v0(typ, size, chatroom_id, basename)
+            head.append(b'<!STREAM>')
+            head.append(pack_key(key, pubkey))
+
+        with open(path, "rb") as f:
+            def content() -> Iterator[bytes]:
+                yield self._name + b'<SEP>'
+                while chunk := f.read(self.chunk_size):
+                    yield chunk
+
+            self._send_blocks(itertools.chain(
+                head, encrypt_aes_stream(content(), key), [b'MSGEND']
+                ))
+
+    def _header_v0(
+            self, typ: MsgType, length: int,
+            chatroom_id: UUID, basename: str
+    ) -> list[bytes | memoryview]:
+        blocks: list[bytes | memoryview] = []
+        blocks.append(typ.value)
+        blocks.append(length.to_bytes(4, "big"))
+        blocks.append(msg_encrypt(chatroom_id.bytes, self.server))
+
+        if typ in FILELIKE:
+            blocks.append(msg_encrypt(basename.encode(), self.server))
 
             _, ext = os.path.splitext(basename)
             if typ == MsgType.VIDEO or ext in PICTURE_EXT:
-                # This one should tell a server whether message
-                # should have preview or not 
-                # Client should send both preveiw and not compressed content
-                # Thus preview byte is always "1"(True) on client side
-                # as client is responsible for sending it
-                self._send_block(b'1')
+                # This one tells the server whether message
+                # should have preview or not, server makes it
+                # and sends it to recipients instead of the content
+                blocks.append(b'1')
 
-        # Separator that differentiates header tags from actual data
-        self._send_block(b'<!DATA>')
+        return blocks
 
-        data = pack_data(encrypt_aes(self._name + b'<SEP>' + msg), pubkey)
-        sz = self.chunk_size
-        for i in range(0, len(data), sz):
-            chunk = data[i:i + sz]
-            self._send_block(chunk)
+    def _tags_v1(
+            self, typ: MsgType, length: int,
+            chatroom_id: UUID, basename: str
+    ) -> Tags:
+        # Timestamp and download id are set by the server
+        tags = Tags(
+            message_type=typ,
+            message_length=length,
+            chatroom_id=chatroom_id,
+            timestamp=datetime.fromtimestamp(0, UTC),
+        )
+        if typ in FILELIKE:
+            # Preview is always requested (see comment in _header_v0)
+            tags = VMediaTags(
+                **tags, basename=basename, preview=True,
+                download_id=UUID(int=0),
+            )
+        return tags
 
-        # END tag to tell receiver to stop reading stream
-        self._send_block(b'MSGEND')
+    def _send_v1(
+            self, msg: bytes, typ: MsgType, pubkey: bytes,
+            chatroom_id: UUID, basename: str
+    ) -> None:
+        tags = self._tags_v1(typ, len(msg), chatroom_id, basename)
+        text, key = encrypt_aes(self._name + b'<SEP>' + msg)
+        blocks = build_v1(tags, (text, key), pubkey, self.chunk_size)
+        self._send_blocks(blocks)
 
-    def _send_block(self, data: bytes):
-        self.s.send(len(data).to_bytes(4, "big"))
-        self.s.send(data)
+    def _send_blocks(self, blocks: Iterable[bytes | memoryview]) -> None:
+        # Frames are joined so header and small messages
+        # take one write (and one TLS record) instead of one per tag
+        with self._lock:
+            for buf in coalesce_frames(blocks, self.chunk_size):
+                self.s.sendall(buf)
 
 class AsyncSender():
     def __init__(
@@ -75,26 +175,89 @@ class AsyncSender():
         self, tags: Tags, msg: bytes, sock: StreamWriter, pubkey: bytes
     ) -> None:
 
-        tag_list = generate_header(tags, pubkey)
+        await self.send_sealed(tags, encrypt_aes(msg), sock, pubkey)
+
+    async def send_sealed(
+        self, tags: Tags, sealed: tuple[bytes, bytes],
+        sock: StreamWriter, pubkey: bytes
+    ) -> None:
+        """Sends message which body was already encrypted by ```encrypt_aes```.
+
+        Used for relaying one message to many recipients: payload is
+        encrypted once and only AES key is wrapped for each recipient.
+
+        Args:
+            tags: ```Tags```
+                TypedDict of type Tags.
+            sealed: ```tuple[bytes, bytes]```
+                Output of ```encrypt_aes``` (ciphertext and AES key).
+            sock: ```StreamWriter```
+                Recipient's stream.
+            pubkey: ```bytes```
+                Public RSA key of recepient.
+        """
+        await self.send_blocks(self.build_sealed(tags, sealed, pubkey), sock)
 
-        for header_tag in tag_list:
-            await self._send_block(header_tag, sock)
+    def build_sealed(
+        self, tags: Tags, sealed: tuple[bytes, bytes], pubkey: bytes,
+        header_version: int = 0
+    ) -> list[bytes | memoryview]:
+        """Builds list of blocks of a message without sending them.
+        Ciphertext blocks are views of ```sealed``` so no payload
+        is copied."""
+        if header_version >= 1:
+            return build_v1(tags, sealed, pubkey, self.chunk_size)
+
+        blocks: list[bytes | memoryview] = []
+        blocks.extend(generate_header(tags, pubkey))
 
         # Separator that differentiates header tags from actual data
-        await self._send_block(b'<!DATA>', sock)
+        blocks.append(b'<!DATA>')
 
-        data = pack_data(encrypt_aes(msg), pubkey)
+        # Receiver joins all data blocks before unpacking, so ciphertext
+        # is sent as is and wrapped key goes in a separate block
+        text, key = sealed
+        view = memoryview(text)
         sz = self.chunk_size
-        for i in range(0, len(data), sz):
-            chunk = data[i:i + sz]
-            await self._send_block(chunk, sock)
+        for i in range(0, len(view), sz):
+            blocks.append(view[i:i + sz])
+        blocks.append(pack_key(key, pubkey))
 
         # END tag to tell receiver to stop reading stream
-        await self._send_block(b'MSGEND', sock)
+        blocks.append(b'MSGEND')
+
+        return blocks
+
+    async def send_blocks(
+        self, blocks: list[bytes | memoryview], sock: StreamWriter
+    ) -> None:
+        # One write and one drain per chunk_size of data
+        # instead of two of each for every block
+        for buf in coalesce_frames(blocks, self.chunk_size):
+            sock.write(buf)
+            await sock.drain()
+
+def build_v1(
+        tags: Tags, sealed: tuple[bytes, bytes],
+        pubkey: bytes, chunk_size: int
+) -> list[bytes | memoryview]:
+    """Builds blocks of a message with binary header (version 1).
 
-    async def _send_block(self, data: bytes, sock: StreamWriter):
-        sock.write(len(data).to_bytes(4, "big"))
-        await sock.drain()
-        sock.write(data)
-        await sock.drain()
+    Layout: ```HEADER_V1``` marker, AES key wrapped with ```pubkey```,
+    header struct encrypted with the same AES key, then ciphertext
+    of the content split into ```chunk_size``` blocks and ```MSGEND```.
+    Only one RSA operation is needed per recipient.
+    """
+    text, key = sealed
+    header, _ = encrypt_aes(pack_header(tags), key)
+    blocks: list[bytes | memoryview] = [
+        HEADER_V1,
+        get_cipher(pubkey).encrypt(key),
+        header,
+    ]
+    view = memoryview(text)
+    for i in range(0, len(view), chunk_size):
+        blocks.append(view[i:i + chunk_size])
+    blocks.append(b'MSGEND')
 
+    return blocks
@@ -24,6 +24,7 @@ from .utils.encryption import (
     )
 from .utils.tools import get_device_id, CLIENT_DIR
 from .components import TextField
+from .message import HEADER_VERSION
 
 
 keys_dir = Path(f"{CLIENT_DIR}/keys")
@@ -34,7 +35,7 @@ class AuthError(Exception):
         super().__init__(*args)
 
 class SignIn(QWidget):
-    name_signal = Signal(str)
+    name_signal = Signal(str, int)
     reinit = Signal()
     def __init__(self, stacked_layout, s: SSLSocket | None,
                  server_pubkey: RsaKey | None):
@@ -165,7 +166,8 @@ class SignIn(QWidget):
                 and self.name_f.hasAcceptableInput()):
             name = self.name_f.text()
             password = self.pass_f.text()
-            name_device = f"{name}<SEP>".encode() + get_device_id(name) 
+            name_device = (f"{name}<SEP>".encode() + get_device_id(name)
+                           + f"<SEP>{HEADER_VERSION}".encode())
             self.s.send(
                 pack_data(encrypt_aes(name_device),
                 self.server_pubkey.export_key())
@@ -187,7 +189,12 @@ class SignIn(QWidget):
                 data, aes, _ = unpack_data(data)
                 aes = my_cipher.decrypt(aes)
                 server_resp = decrypt_aes(data, aes)
-                salt, challenge = server_resp.split(b"<SEP>")
+                salt, challenge, *version = server_resp.split(b"<SEP>")
+                # Server sends the header version to use unless it is 0.
+                # Servers without binary headers can't parse the version
+                # this client signs in with, so the server must be
+                # upgraded before clients are
+                self.header_version = int(version[0]) if version else 0
                 key = generate_key(password, salt)
                 check_bytestring = decrypt_aes(challenge, key)
                 self.s.send(check_bytestring)
@@ -237,7 +244,7 @@ class SignIn(QWidget):
             return
 
         self.stacked_layout.setCurrentIndex(3)
-        self.name_signal.emit(name)
+        self.name_signal.emit(name, self.header_version)
         for f in self.fields:
             f.clear()
     
@@ -1,10 +1,26 @@
+from functools import lru_cache
+from typing import Iterable, Iterator
+
 from Crypto.Cipher import AES, PKCS1_OAEP
+from Crypto.Cipher.PKCS1_OAEP import PKCS1OAEP_Cipher
 from Crypto.PublicKey import RSA
 from Crypto.PublicKey.RSA import RsaKey
 from Crypto.Hash import SHA256
 from Crypto.Random import get_random_bytes
 from Crypto.Protocol.KDF import PBKDF2
 
+@lru_cache(maxsize=512)
+def import_key(key: bytes) -> RsaKey:
+    """```RSA.import_key``` cached by key bytes.
+    Hits and misses are available through ```import_key.cache_info()```."""
+    return RSA.import_key(key)
+
+@lru_cache(maxsize=512)
+def get_cipher(key: bytes) -> PKCS1OAEP_Cipher:
+    """PKCS1_OAEP cipher for PEM encoded RSA key cached by key bytes.
+    Hits and misses are available through ```get_cipher.cache_info()```."""
+    return PKCS1_OAEP.new(import_key(key))
+
 def generate_key(passw: str, salt: bytes, lenght: int = 32) -> bytes:
     return PBKDF2(passw, salt, dkLen=lenght, count=1000000)
 
@@ -21,6 +37,18 @@ def encrypt_aes(msg: bytes, key: bytes | None = None) -> tuple[bytes, bytes]:
     ciphertext, tag = cipher.encrypt_and_digest(msg)
     return bytes(cipher.nonce) + ciphertext + tag, key
 
+def encrypt_aes_stream(
+        chunks: Iterable[bytes], key: bytes
+) -> Iterator[bytes]:
+    """Encrypts ```chunks``` one by one. Joined output is the same as
+    the ciphertext of ```encrypt_aes``` (nonce, ciphertext and tag),
+    so it can be decrypted by ```decrypt_aes``` or block by block."""
+    cipher = AES.new(key, AES.MODE_GCM)
+    yield bytes(cipher.nonce)
+    for chunk in chunks:
+        yield cipher.encrypt(chunk)
+    yield cipher.digest()
+
 def decrypt_aes(encrypted_msg: bytes, key: bytes) -> bytes:
     nonce = encrypted_msg[:16]
     tag = encrypted_msg[-16:]
@@ -30,13 +58,18 @@ def decrypt_aes(encrypted_msg: bytes, key: bytes) -> bytes:
     return decrypted_message
 
 def pack_data(msg: tuple[bytes, bytes], public_key: bytes) -> bytes:
-    pubkey = RSA.import_key(public_key)
-    cipher = PKCS1_OAEP.new(pubkey)
     text, key = msg
-    data: bytes = text + b'<SEP>' + cipher.encrypt(key) + b'<SEP>' + public_key
+    data: bytes = text + pack_key(key, public_key)
     return data
 
+def pack_key(key: bytes, public_key: bytes) -> bytes:
+    """Wraps AES session key with recipient's public RSA key.
+    Result is the trailing part of ```pack_data``` output, so it can be
+    appended to a ciphertext that was encrypted only once."""
+    cipher = get_cipher(public_key)
+    return b'<SEP>' + cipher.encrypt(key) + b'<SEP>' + public_key
+
 def unpack_data(msg: bytes) -> tuple[bytes, bytes, RsaKey]:
     text, aes, pub = msg.split(b'<SEP>')
-    data: tuple[bytes, bytes, RsaKey] = text, aes, RSA.import_key(pub)
+    data: tuple[bytes, bytes, RsaKey] = text, aes, import_key(pub)
     return data
@@ -1,2 +1,3 @@
 from .sender_service import SenderServiceWorker
 from .receiver_service import ReceiverServiceWorker
+from .transfer_scheduler import TransferScheduler, Transfer, Priority
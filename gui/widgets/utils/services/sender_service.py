@@ -1,57 +1,110 @@
+import json
 import os
 import shutil
 import tempfile
+from hashlib import sha256
+from queue import Queue, Empty
 from ssl import SSLSocket
 from uuid import UUID
 from PySide6.QtCore import QObject
-from threading import Thread
+from threading import Lock
 from pathlib import Path
 
 from ...message import ChunkSize, Sender, MsgType
-from ...utils.tools import CLIENT_DIR
+from ...utils.tools import CLIENT_DIR, compress_image, qimage_to_bytes
+from .transfer_scheduler import TransferScheduler, Transfer, Priority
 
 video_extensions = (".mp4", ".m4a", ".m4v", ".3gp", ".3g2", ".avi", ".mkv",
                     ".webm", ".f4v", ".lrv")
 documents_dir = Path(f"{CLIENT_DIR}/downloads/documents")
+uploads_dir = Path(f"{CLIENT_DIR}/uploads")
+# Files of this size and bigger are uploaded in chunks,
+# so an interrupted upload continues where it stopped
+resumable_min = 8 * ChunkSize.M1.value
+upload_chunk = ChunkSize.M1.value
 
 class SenderServiceWorker(QObject):
     def __init__(
             self, sock: SSLSocket, name: str, server_pubkey: bytes,
-            buffer_limit: ChunkSize
+            buffer_limit: ChunkSize, header_version: int = 0
     ) -> None:
         super().__init__()
 
         self.sender_wk = Sender(
-                sock, name, server_pubkey, buffer_limit
+                sock, name, server_pubkey, buffer_limit, header_version
                 )
         self.s_pubkey = server_pubkey
+        self.scheduler = TransferScheduler()
+        # Unfinished uploads are kept there between sessions
+        uploads_dir.mkdir(parents=True, exist_ok=True)
+        self._uploads_file = uploads_dir / f"{name}.json"
+        self._uploads_lock = Lock()
+        # Upload id -> queue for the offset server replies with
+        self._offsets: dict[UUID, Queue[int]] = {}
 
     def send_text(self, msg: bytes, public_key: bytes, room_id: UUID) -> None:
-        self.sender_wk.send_message(msg, MsgType.TEXT, public_key, room_id)
+        self.scheduler.write(
+            lambda: self.sender_wk.send_message(
+                msg, MsgType.TEXT, public_key, room_id
+                ),
+            Priority.TEXT
+            )
 
     def send_static_image(
-            self, data: bytes, public_key: bytes, room_id: UUID
-    ) -> None:
-        self.sender_wk.send_message(
-                data, MsgType.IMAGE, public_key,
-                room_id, basename=".webp"
-                )
+            self, path: str, public_key: bytes, room_id: UUID
+    ) -> Transfer:
+        """Compresses image at ```path``` and sends it."""
+        return self.scheduler.submit(lambda transfer: self._send_image(
+                transfer, path, public_key, room_id
+                ))
+
+    def send_file(
+            self, path: str, public_key: bytes, room_id: UUID
+    ) -> Transfer:
+        return self.scheduler.submit(lambda transfer: self._send_file(
+                transfer, path, public_key, room_id
+                ))
+
+    def stop(self) -> None:
+        """Cancels queued transfers, unfinished uploads are resumed
+        during the next session."""
+        self.scheduler.stop()
 
-    def send_file(self, path: str, public_key: bytes, room_id: UUID) -> None:
-        t = Thread(target=self._send_file, args=(path, public_key, room_id))
-        t.start()
+    def _write(self, priority: Priority, send, *args, **kwargs) -> None:
+        """Queues a message for the writer thread and waits until it is
+        written.
+
+        :raises CancelledError: if the scheduler was stopped
+        :raises Exception: raised by the send if the message wasn't
+                           written, e.g. ```OSError```
+        """
+        self.scheduler.write(lambda: send(*args, **kwargs), priority).result()
+
+    def _send_image(
+            self, transfer: Transfer, path: str,
+            public_key: bytes, room_id: UUID
+    ) -> None:
+        data = qimage_to_bytes(compress_image(path))
+        if transfer.cancelled:
+            return
+        self._write(
+            Priority.FILE, self.sender_wk.send_message,
+            data, MsgType.IMAGE, public_key, room_id, basename=".webp"
+            )
 
-    def _send_file(self, path: str, public_key: bytes, room_id: UUID) -> None:
+    def _send_file(
+            self, transfer: Transfer, path: str,
+            public_key: bytes, room_id: UUID
+    ) -> None:
         ext = os.path.splitext(path)[1]
         filename = os.path.basename(path)
-        with open(path, "rb") as f:
-            data = f.read()
 
         # Move file to an attachments directory if it is a temporary file
         temp_dir = tempfile.gettempdir()
         documents_dir.mkdir(parents=True, exist_ok=True)
         if temp_dir in path:
             shutil.move(path, f"{documents_dir}/{filename}")
+            path = f"{documents_dir}/{filename}"
 
         if ext == ".gif":
             typ = MsgType.IMAGE
@@ -60,13 +113,153 @@ class SenderServiceWorker(QObject):
         else:
             typ = MsgType.DOCUMENT
 
-        self.sender_wk.send_message(
-                data, typ, public_key,
-                room_id, filename
+        if transfer.cancelled:
+            return
+        # Older servers know nothing about uploads
+        if (self.sender_wk.header_version >= 1
+                and os.path.getsize(path) >= resumable_min):
+            self._upload(transfer, path, typ, room_id, filename)
+            return
+
+        self._write(
+            Priority.FILE, self.sender_wk.send_file,
+            path, typ, public_key, room_id, filename
+            )
+
+    def send_cmd(
+            self, cmd: bytes, room_id: UUID,
+            priority: Priority = Priority.TEXT
+    ) -> None:
+        self.scheduler.write(
+            lambda: self.sender_wk.send_message(
+                cmd, MsgType.SERVER, self.s_pubkey, room_id
+                ),
+            priority
+            )
+
+    def resume_uploads(self) -> None:
+        """Continues uploads left unfinished in previous sessions."""
+        for upload_id, info in self._load_uploads().items():
+            self.scheduler.submit(
+                lambda transfer, upload_id=UUID(hex=upload_id), info=info:
+                    self._resume(transfer, upload_id, info)
                 )
 
-    def send_cmd(self, cmd: bytes, room_id: UUID) -> None:
-        self.sender_wk.send_message(
-                cmd, MsgType.SERVER,
-                self.s_pubkey, room_id
+    def on_upload_offset(self, upload_id: UUID, offset: int) -> None:
+        """Handles server's reply with the offset to continue upload from."""
+        queue = self._offsets.get(upload_id)
+        if queue is not None:
+            queue.put(offset)
+            return
+        # Server has found upload incomplete after it was sent
+        info = self._load_uploads().get(upload_id.hex)
+        if info is not None:
+            self.scheduler.submit(lambda transfer: self._send_chunks(
+                transfer, upload_id, info, offset
+                ))
+
+    def on_uploaded(self, upload_id: UUID) -> None:
+        with self._uploads_lock:
+            uploads = self._load_uploads()
+            uploads.pop(upload_id.hex, None)
+            self._save_uploads(uploads)
+
+    def on_upload_failed(self, upload_id: UUID) -> None:
+        """Forgets upload the server has rejected, so it isn't resumed."""
+        print(f"[-] Server rejected upload {upload_id.hex}")
+        self.on_uploaded(upload_id)
+
+    def _upload(
+            self, transfer: Transfer, path: str, typ: MsgType,
+            room_id: UUID, basename: str
+    ) -> None:
+        # Same file sent to the same room gets the same id,
+        # so it is resumed even after the client is restarted
+        stat = os.stat(path)
+        upload_id = UUID(bytes=sha256(
+                f"{os.path.abspath(path)}{stat.st_size}"
+                f"{stat.st_mtime_ns}{room_id}".encode()
+                ).digest()[:16])
+        info = {
+            "path": path,
+            "type": typ.value.decode(),
+            "room_id": room_id.hex,
+            "basename": basename,
+            "size": stat.st_size,
+        }
+        with self._uploads_lock:
+            uploads = self._load_uploads()
+            uploads[upload_id.hex] = info
+            self._save_uploads(uploads)
+        self._resume(transfer, upload_id, info)
+
+    def _resume(
+            self, transfer: Transfer, upload_id: UUID, info: dict
+    ) -> None:
+        if (not os.path.exists(info["path"])
+                or os.path.getsize(info["path"]) != info["size"]):
+            # File was changed or removed since the upload began
+            self.on_uploaded(upload_id)
+            return
+        if transfer.cancelled:
+            return
+
+        queue: Queue[int] = Queue()
+        self._offsets[upload_id] = queue
+        try:
+            self.send_cmd(
+                f"upload<SEP>{upload_id.hex}".encode(),
+                UUID(hex=info["room_id"])
                 )
+            offset = queue.get(timeout=30)
+        except Empty:
+            # Upload is resumed during the next session
+            return
+        finally:
+            del self._offsets[upload_id]
+        if transfer.cancelled:
+            return
+
+        self._send_chunks(transfer, upload_id, info, offset)
+
+    def _send_chunks(
+            self, transfer: Transfer, upload_id: UUID,
+            info: dict, offset: int
+    ) -> None:
+        room_id = UUID(hex=info["room_id"])
+        try:
+            with open(info["path"], "rb") as f:
+                f.seek(offset)
+                # Each chunk is a separate message,
+                # so text messages are sent in between
+                while chunk := f.read(upload_chunk):
+                    if transfer.cancelled:
+                        return
+                    self._write(
+                        Priority.FILE, self.sender_wk.send_message,
+                        f"chunk<SEP>{upload_id.hex}<SEP>{offset}<SEP>"
+                        .encode() + chunk,
+                        MsgType.SERVER, self.s_pubkey, room_id
+                        )
+                    offset += len(chunk)
+            if transfer.cancelled:
+                return
+            self.send_cmd(
+                f"upload_done<SEP>{upload_id.hex}<SEP>{info['type']}"
+                f"<SEP>{info['size']}<SEP>{info['basename']}".encode(),
+                room_id, Priority.FILE
+                )
+        except OSError:
+            # Connection is lost, upload is resumed during the next session
+            return
+
+    def _load_uploads(self) -> dict[str, dict]:
+        try:
+            with open(self._uploads_file) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save_uploads(self, uploads: dict[str, dict]) -> None:
+        with open(self._uploads_file, "w") as f:
+            json.dump(uploads, f)
@@ -0,0 +1,127 @@
+import itertools
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from enum import IntEnum
+from queue import PriorityQueue
+from threading import Event, Lock, Thread
+from typing import Callable
+
+
+class Priority(IntEnum):
+    # Lower value is written first
+    TEXT = 0
+    FILE = 1
+
+
+class Transfer():
+    """Handle of a job submitted to ```TransferScheduler```."""
+    def __init__(self) -> None:
+        self._cancelled = Event()
+        self.done = Event()
+
+    def cancel(self) -> None:
+        """Job that hasn't started is skipped, running one stops
+        before its next message."""
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+
+# Priority, sequence number (keeps order of equal priorities)
+# and the send itself, None stops the writer
+_Write = tuple[int, int, Callable[[], None] | None, Future]
+
+class TransferScheduler():
+    """Runs sending jobs of ```SenderServiceWorker```.
+
+    Jobs (compressing images, reading files, waiting for replies of
+    the server) run in a pool of ```workers``` threads. Messages they
+    produce are written to the socket by a single writer thread in order
+    of priority, so a text message goes ahead of queued attachments and
+    frames of different messages never interleave.
+    """
+    def __init__(self, workers: int = 4) -> None:
+        self._pool = ThreadPoolExecutor(workers, "transfer")
+        self._writes: PriorityQueue[_Write] = PriorityQueue()
+        self._seq = itertools.count()
+        self._transfers: set[Transfer] = set()
+        # Guards stopping, so no write is queued after the writer's sentinel
+        self._lock = Lock()
+        self._stopped = False
+        self._writer = Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def submit(self, job: Callable[[Transfer], None]) -> Transfer:
+        """Runs ```job``` in the pool, after ```stop``` it is skipped
+        and the returned transfer is already cancelled."""
+        transfer = Transfer()
+        with self._lock:
+            if self._stopped:
+                transfer.cancel()
+                transfer.done.set()
+                return transfer
+            self._transfers.add(transfer)
+            self._pool.submit(self._run, job, transfer)
+        return transfer
+
+    def write(
+            self, send: Callable[[], None], priority: Priority
+    ) -> Future:
+        """Queues ```send``` for the writer thread.
+
+        :return: future that is done after the message is written,
+                 holds the exception if it wasn't and is cancelled
+                 if the scheduler is stopped
+        :rtype: ```Future```
+        """
+        future: Future = Future()
+        with self._lock:
+            if self._stopped:
+                future.cancel()
+                return future
+            self._writes.put((priority, next(self._seq), send, future))
+        return future
+
+    def stop(self) -> None:
+        """Cancels every transfer and stops the writer
+        after the messages that are already queued,
+        later writes are cancelled."""
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+            self._writes.put((len(Priority), next(self._seq), None, Future()))
+        for transfer in list(self._transfers):
+            transfer.cancel()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, job: Callable[[Transfer], None], transfer: Transfer) -> None:
+        try:
+            if not transfer.cancelled:
+                job(transfer)
+        except CancelledError:
+            # Scheduler was stopped while the job waited for a write
+            pass
+        except Exception as e:
+            print(f"[-] Transfer has failed: {e!r}")
+        finally:
+            transfer.done.set()
+            self._transfers.discard(transfer)
+
+    def _write_loop(self) -> None:
+        while True:
+            _, _, send, future = self._writes.get()
+            if send is None:
+                break
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                send()
+            except Exception as e:
+                # Writer keeps going, otherwise every later write
+                # would wait for it forever
+                print(f"[-] Message wasn't sent: {e!r}")
+                future.set_exception(e)
+            else:
+                future.set_result(None)
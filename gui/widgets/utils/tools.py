@@ -8,6 +8,7 @@ from time import perf_counter
 from io import BytesIO
 from collections import OrderedDict
 from hashlib import sha256
+from threading import Lock
 
 from PIL import Image, ImageOps
 from pillow_heif import register_heif_opener, register_avif_opener
@@ -21,6 +22,22 @@ def generate_name() -> str:
     timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
     return f"{dust}_{timestamp}"
 
+def format_size(filesize: int) -> str:
+    """Formats size in bytes into human readable string"""
+    kb = filesize / 1024
+    mb = kb / 1024
+    gb = mb / 1024
+
+    if gb > 1:
+        return f"{gb:.1f} GB"
+    elif mb > 1:
+        return f"{mb:.1f} MB"
+    elif kb > 1:
+        return f"{kb:.1f} KB"
+    elif str(filesize)[-1] == "1":
+        return f"{filesize} byte"
+    return f"{filesize} bytes"
+
 def get_device_id(name: str) -> bytes:
     device = platform.uname()
     system = device.system
@@ -34,18 +51,24 @@ def get_device_id(name: str) -> bytes:
 def cache_check(max_size: int):
     def decorator(func):
         cache = OrderedDict()
+        # Cached functions are called from transfer threads too
+        lock = Lock()
         @wraps(func)
         def wrapper(*args, **kwargs):
             key = (args, frozenset(kwargs.items()))
-            if key in cache:
-                # Move the accessed key to the end of the OrderedDict
-                cache.move_to_end(key)
-                return cache[key]
+            with lock:
+                if key in cache:
+                    # Move the accessed key to the end of the OrderedDict
+                    cache.move_to_end(key)
+                    return cache[key]
+            # Lock isn't held while computing, so slow calls don't
+            # block each other, concurrent misses compute it twice
             result = func(*args, **kwargs)
-            cache[key] = result
-            # If the cache has exceeded max_size, remove the oldest item
-            if len(cache) > max_size:
-                cache.popitem(last=False)
+            with lock:
+                cache[key] = result
+                # If the cache has exceeded max_size, remove the oldest item
+                if len(cache) > max_size:
+                    cache.popitem(last=False)
             return result
         return wrapper
     return decorator
@@ -0,0 +1,57 @@
+import shutil
+import subprocess
+from io import BytesIO
+from pathlib import Path
+
+from PIL import Image, ImageOps
+from pillow_heif import register_heif_opener, register_avif_opener
+
+
+# Maximum dimension of a preview
+PREVIEW_SIZE = 320
+
+register_heif_opener()
+register_avif_opener()
+
+def make_preview(path: Path, video: bool = False) -> bytes | None:
+    """Makes small WEBP thumbnail of an image or of the first frame
+    of a video. Frames are extracted with ```ffmpeg```, so videos get
+    no preview if it is not installed.
+
+    :return: WEBP image or ```None``` if preview can't be made
+    :rtype: ```bytes | None```
+    """
+    src = _first_frame(path) if video else path
+    if src is None:
+        return None
+
+    try:
+        with Image.open(src) as img:
+            # Lets JPEG decoder skip most of the pixels of big photos
+            img.draft("RGB", (PREVIEW_SIZE, PREVIEW_SIZE))
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE))
+            if img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA")
+            out = BytesIO()
+            img.save(out, format="WEBP", quality=60)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+    return out.getvalue()
+
+def _first_frame(path: Path) -> BytesIO | None:
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        return None
+    try:
+        result = subprocess.run(
+            [ffmpeg, "-v", "error", "-i", str(path), "-frames:v", "1",
+             "-f", "image2pipe", "-c:v", "png", "-"],
+            capture_output=True, timeout=30
+        )
+    except subprocess.TimeoutExpired:
+        return None
+    if result.returncode != 0 or not result.stdout:
+        return None
+    return BytesIO(result.stdout)
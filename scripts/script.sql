@@ -53,9 +53,9 @@ CREATE TABLE IF NOT EXISTS public.messages
     sender_id bigint NOT NULL,
     message_type varchar(3) NOT NULL,
     length bigint NOT NULL,
-    content path NOT NULL,
+    content bytea NOT NULL,
     basename varchar(250),
-    preview path,
+    preview bytea,
     timestamp timestamp with time zone NOT NULL,
     PRIMARY KEY (id, timestamp),
     FOREIGN KEY (chatroom_id) REFERENCES public.chatrooms (id) MATCH SIMPLE
@@ -66,7 +66,12 @@ CREATE TABLE IF NOT EXISTS public.messages
         ON UPDATE CASCADE
 )
 PARTITION BY RANGE (timestamp);
-CREATE INDEX ON public.messages (chatroom_id);
+-- Serves history pages of a chatroom ordered by (timestamp, id)
+CREATE INDEX ON public.messages (chatroom_id, timestamp, id);
+-- Finds chatrooms a blob was sent to, content of file-like
+-- messages is the download id of the blob
+CREATE INDEX ON public.messages (content)
+    WHERE message_type IN ('IMG', 'VID', 'DOC');
 
 -- Function for managing partition creation and deletion on messages table
 CREATE OR REPLACE FUNCTION manage_messages_partitions()
@@ -1,29 +1,47 @@
 import asyncio
 from asyncio.streams import StreamReader, StreamWriter
 from asyncio import IncompleteReadError
+from collections import OrderedDict
 from configparser import ConfigParser
+from datetime import UTC, datetime, timedelta
 import os
+import signal
 import socket
 import ssl
+import traceback
 from pathlib import Path
-from typing import TypedDict
+from typing import Callable, TypedDict
 from uuid import UUID
 
 from Crypto.PublicKey import RSA
 from Crypto.Cipher import PKCS1_OAEP
 import pyotp
 
-from database import Connect, NoDataFoundError
+from database import (
+    AsyncConnect, ConnectionPool, MessageBatcher, MessageRow, NoDataFoundError,
+    fit_basename,
+)
+from crypto_pool import CryptoPool
+from blob_store import BlobStore
+from previews import make_preview
+import bus
 from gui.widgets.utils.encryption import (
     encrypt_aes, decrypt_aes, generate_sha256,
-    pack_data, unpack_data,
 )
 from gui.widgets.message import (
         ChunkSize,
         AsyncSender,
         AsyncReceiver,
         Tags,
+        HistoryEntry,
         MsgType,
+        Outbox,
+        pack_history,
+        VMediaTags,
+        FILELIKE,
+        PICTURE_EXT,
+        SlowConsumer,
+        HEADER_VERSION,
         )
 from generate_ssl_tls import generate_cert, check_cert
 from gui.widgets.utils.tools import SERVER_DIR
@@ -59,6 +77,9 @@ class UserInfo(TypedDict):
     sock: StreamWriter
     public_key: bytes
     friend_code: str
+    rooms: set[UUID]
+    outbox: Outbox
+    header_version: int
 
 class UserAuthInfo(TypedDict):
     password: bytes
@@ -68,6 +89,8 @@ class UserAuthInfo(TypedDict):
     new_device: bool
 
 auth_users: dict[str, UserInfo] = {}
+# Chatroom id -> usernames of its members that are currently online
+rooms: dict[UUID, set[str]] = {}
 
 config = ConfigParser()
 with open(f'{SERVER_DIR}/server.conf.enc', 'rb') as f:
@@ -78,46 +101,489 @@ with open(f'{SERVER_DIR}/server.conf.enc', 'rb') as f:
 
 passwd = config.get('Database', 'DB_PASSWORD')
 db_name = config.get('Database', 'DB_NAME')
+db_pool = ConnectionPool(
+        passwd, db_name,
+        config.getint('Database', 'DB_POOL_MIN', fallback=2),
+        config.getint('Database', 'DB_POOL_MAX', fallback=20),
+        )
+# Queries run in a thread pool so they don't stall the event loop
+db = AsyncConnect(db_pool)
+# Messages are saved in batches in the background
+history = MessageBatcher(
+        db,
+        config.getint('Database', 'MESSAGES_BATCH', fallback=256),
+        config.getfloat('Database', 'MESSAGES_FLUSH_INTERVAL', fallback=1.0),
+        )
+# Messages in one page of chatroom's history
+history_page = config.getint('Database', 'HISTORY_PAGE', fallback=50)
+# Content of files, images and videos, messages carry only its download id
+blobs = BlobStore(SERVER_DIR / "blobs")
+# Blobs are sent in chunks of this size
+download_chunk = config.getint(
+        'Relay', 'DOWNLOAD_CHUNK', fallback=ChunkSize.M1.value
+        )
+# Blobs being sent to users
+downloads: set[asyncio.Task] = set()
+# File-like messages waiting for their preview to be generated
+previews: set[asyncio.Task] = set()
+# Download id -> chatrooms of recently relayed file-like messages,
+# which may not be saved to the database yet
+recent_files: OrderedDict[UUID, set[UUID]] = OrderedDict()
+recent_files_max = 4096
+# Unfinished uploads are removed after this many seconds of inactivity
+upload_ttl = config.getint('Relay', 'UPLOAD_TTL', fallback=7 * 24 * 3600)
+
+# Server processes sharing the port, each with its own event loop
+workers = config.getint('Server', 'WORKERS', fallback=1)
+if not hasattr(os, "fork"):
+    workers = 1
+bus_path = f"{SERVER_DIR}/bus.sock"
+# Connection to other workers, set up only if there are several of them
+bus_client: bus.BusClient | None = None
+# Users signed in on other workers: username -> friend code
+remote_users: dict[str, str] = {}
+# Users who are signing in on this worker
+signing_in: set[str] = set()
+
+# Processes for RSA work of handshakes and message headers.
+# Several server workers already use several cores,
+# so by default it is used only by a single one
+crypto = CryptoPool(
+        SERVER_RSA.export_key(),
+        config.getint(
+            'Server', 'CRYPTO_WORKERS',
+            fallback=max((os.cpu_count() or 1) - 1, 0) if workers == 1 else 0
+            ),
+        )
+
+# Limits of a queue of undelivered messages for each connection
+outbox_max_bytes = config.getint(
+        'Relay', 'OUTBOX_MAX_BYTES', fallback=64 * ChunkSize.M1.value
+        )
+outbox_max_messages = config.getint(
+        'Relay', 'OUTBOX_MAX_MESSAGES', fallback=512
+        )
+slow_consumer = SlowConsumer(
+        config.get('Relay', 'SLOW_CONSUMER', fallback='drop')
+        )
+
+def join_room(room_id: UUID, username: str) -> None:
+    rooms.setdefault(room_id, set()).add(username)
+    auth_users[username]["rooms"].add(room_id)
+
+def leave_room(room_id: UUID, username: str) -> None:
+    auth_users[username]["rooms"].discard(room_id)
+    members = rooms.get(room_id)
+    if members is None:
+        return
+    members.discard(username)
+    if not members:
+        del rooms[room_id]
 
 async def listen_for_client(reader: StreamReader, writer: StreamWriter, 
                             username: str) -> None:
-    receiver = AsyncReceiver(reader, s_cipher, buffer_limit)
+    receiver = AsyncReceiver(reader, s_cipher, buffer_limit, crypto, blobs)
     sender = AsyncSender(buffer_limit)
 
     commands = {
-            "code": send_fcode
+            "code": send_fcode,
+            "history": send_history,
+            "download": send_blob,
+            "upload": start_upload,
+            "upload_done": finish_upload,
+            }
+    # Commands which argument is binary data
+    binary_commands = {
+            "chunk": receive_chunk,
             }
  
-    with Connect(passwd, db_name) as db:
+    try:
         while True:
             try:
                 tags, data = await receiver.receive_message()
                 if tags["message_type"] == MsgType.SERVER:
-                    cmd = data.decode().split("<SEP>", 1)[1]
+                    # Command may be followed by its arguments
+                    _, cmd, *rest = data.split(b"<SEP>", 2)
+                    cmd = cmd.decode()
+                    if cmd in binary_commands:
+                        await binary_commands[cmd](
+                                sender, username, rest[0], tags=tags
+                                )
+                        continue
+                    args = rest[0].decode().split("<SEP>") if rest else []
                     await commands[cmd](
-                            sender, writer, username, tags=tags
+                            sender, writer, username, *args, tags=tags
                             )
                     continue
-                for u, info in auth_users.items():
-                    if u != username:
-                        w = info["sock"]
-                        pubkey = info["public_key"]
-                        await sender.send_message(tags, data, w, pubkey)
-            except IncompleteReadError:
+                if username not in rooms.get(tags["chatroom_id"], set()):
+                    continue
+                await accept(sender, tags, data, username)
+            except (IncompleteReadError, ConnectionError):
                 # Client disconnects
                 print("Socket is closed.")
-                del auth_users[username]
-                writer.close()
                 break
+            except Exception as e:
+                # Malformed message or unknown command
+                # doesn't end the connection
+                print(f"[-] Message of {username} is dropped: {e!r}")
+    finally:
+        auth_users[username]["outbox"].close()
+        for room_id in list(auth_users[username]["rooms"]):
+            leave_room(room_id, username)
+        del auth_users[username]
+        writer.close()
+        if bus_client is not None:
+            await bus_client.publish({"event": "offline", "user": username})
+
+async def accept(
+        sender: AsyncSender, tags: Tags, data: bytes, username: str
+) -> None:
+    """Delivers message sent by ```username``` and saves it to history.
+    Messages needing a preview are delivered once it is generated
+    in the background, so commands of the sender are handled meanwhile."""
+    if tags.get("preview"):
+        task = asyncio.create_task(
+                accept_with_preview(sender, tags, data, username)
+                )
+        previews.add(task)
+        task.add_done_callback(previews.discard)
+        return
+    await deliver(sender, tags, data, username)
+
+async def accept_with_preview(
+        sender: AsyncSender, tags: Tags, data: bytes, username: str
+) -> None:
+    # Recipients get thumbnail with the message
+    # and download content itself on demand
+    try:
+        preview = await get_preview(tags)
+    except Exception as e:
+        print(f"[-] Failed to make preview: {e}")
+        preview = None
+    tags["preview"] = preview is not None #type: ignore
+    await deliver(sender, tags, data + (preview or b""), username)
+
+async def deliver(
+        sender: AsyncSender, tags: Tags, data: bytes, username: str
+) -> None:
+    relay(sender, tags, data, username)
+    remember_file(tags)
+    history.add(to_row(tags, data, username))
+    if bus_client is not None:
+        await bus_client.publish({
+            "event": "message",
+            "user": username,
+            "tags": tags,
+            "data": data,
+        })
+
+def reply(sender: AsyncSender, username: str, tags: Tags, msg: bytes) -> bool:
+    """Queues server's response to a command of ```username```.
+    Responses are never dropped as the client may wait for them
+    (bulk ones like downloads wait for room in the outbox instead)."""
+    info = auth_users[username]
+    return info["outbox"].put(sender.build_sealed(
+            tags, encrypt_aes(msg), info["public_key"],
+            info["header_version"]
+            ), force=True)
+
+def relay(sender: AsyncSender, tags: Tags, data: bytes, username: str) -> None:
+    """Queues message to members of its chatroom connected to this worker."""
+    members = rooms.get(tags["chatroom_id"], set())
+    if not members - {username}:
+        return
+    # Payload is encrypted once and only AES key
+    # is wrapped for every recipient
+    sealed = encrypt_aes(data)
+    for u in list(members):
+        if u != username and u in auth_users:
+            info = auth_users[u]
+            info["outbox"].put(sender.build_sealed(
+                    tags, sealed, info["public_key"],
+                    info["header_version"]
+                    ))
+
+def remember_file(tags: Tags) -> None:
+    if tags["message_type"] not in FILELIKE:
+        return
+    dl_id = tags["download_id"] #type: ignore
+    recent_files.setdefault(dl_id, set()).add(tags["chatroom_id"])
+    recent_files.move_to_end(dl_id)
+    if len(recent_files) > recent_files_max:
+        recent_files.popitem(last=False)
+
+async def can_download(username: str, dl_id: UUID) -> bool:
+    """Tells if blob ```dl_id``` was sent to a chatroom of ```username```.
+    Download ids are hashes of content, so knowing one isn't enough."""
+    user_rooms = auth_users[username]["rooms"]
+    if user_rooms & recent_files.get(dl_id, set()):
+        return True
+    file_rooms = await db.get_file_rooms(
+            dl_id, [t.value.decode() for t in FILELIKE]
+            )
+    return not user_rooms.isdisjoint(file_rooms)
+
+async def get_preview(tags: Tags) -> bytes | None:
+    dl_id = tags["download_id"] #type: ignore
+    preview = await asyncio.to_thread(blobs.get_preview, dl_id)
+    if preview is not None:
+        return preview
+    preview = await asyncio.to_thread(
+            make_preview, blobs.path(dl_id),
+            tags["message_type"] == MsgType.VIDEO
+            )
+    if preview is not None:
+        await asyncio.to_thread(blobs.put_preview, dl_id, preview)
+    return preview
+
+def to_row(tags: Tags, data: bytes, username: str) -> MessageRow:
+    # Content is preceded by sender's name
+    _, content = data.split(b"<SEP>", 1)
+    preview = None
+    if tags["message_type"] in FILELIKE:
+        # File-like messages carry only preview of the content
+        preview = content or None
+        content = tags["download_id"].bytes #type: ignore
+    # Client may send a name longer than the column
+    basename = tags.get("basename")
+    return MessageRow(
+        chatroom_id=tags["chatroom_id"],
+        sender=username,
+        message_type=tags["message_type"].value.decode(),
+        length=tags["message_length"],
+        content=content,
+        basename=basename and fit_basename(basename),
+        preview=preview,
+        timestamp=tags["timestamp"],
+    )
+
+async def claim(username: str) -> bool:
+    """Reserves ```username``` for signing in on this worker,
+    so the same user can't sign in twice at once."""
+    if username in auth_users or username in signing_in:
+        return False
+    if bus_client is not None and not await bus_client.claim(username):
+        return False
+    signing_in.add(username)
+    return True
+
+async def release(username: str) -> None:
+    """Drops reservation of a user who failed to sign in."""
+    signing_in.discard(username)
+    if bus_client is not None:
+        await bus_client.release(username)
+
+async def on_bus_event(event: bus.Event) -> None:
+    match event["event"]:
+        case "online":
+            remote_users[event["user"]] = event["code"]
+        case "offline":
+            remote_users.pop(event["user"], None)
+        case "code":
+            set_fcode(event["user"], event["code"])
+        case "message":
+            relay(bus_sender, event["tags"], event["data"], event["user"])
+            remember_file(event["tags"])
+
+bus_sender = AsyncSender(buffer_limit)
+
+def get_fcode(username: str) -> str:
+    """:raises KeyError: if user is not online on any worker."""
+    if username in auth_users:
+        return auth_users[username]["friend_code"]
+    return remote_users[username]
+
+def set_fcode(username: str, code: str) -> None:
+    if username == "admin":
+        default_code["admin"] = code
+    elif username in auth_users:
+        auth_users[username]["friend_code"] = code
+    elif username in remote_users:
+        remote_users[username] = code
+
+async def renew_fcode(username: str) -> None:
+    code = generate_sha256()
+    set_fcode(username, code)
+    if bus_client is not None:
+        await bus_client.publish(
+                {"event": "code", "user": username, "code": code}
+                )
 
 async def send_fcode(
         sender: AsyncSender, writer: StreamWriter,
         username: str, *, tags: Tags
 ) -> None:
     code = auth_users[username]["friend_code"]
-    user_pub = auth_users[username]["public_key"]
-    await sender.send_message(tags, f"code<SEP>{code}".encode(), writer, user_pub)
- 
+    reply(sender, username, tags, f"code<SEP>{code}".encode())
+
+async def send_history(
+        sender: AsyncSender, writer: StreamWriter, username: str,
+        direction: str = "before", timestamp_us: str = "", msg_id: str = "0",
+        *, tags: Tags
+) -> None:
+    """Sends one page of messages of ```tags["chatroom_id"]``` before
+    or after the message with ```timestamp_us``` and ```msg_id```.
+    Without ```timestamp_us``` the latest page is sent."""
+    room_id = tags["chatroom_id"]
+    if username not in rooms.get(room_id, set()):
+        return
+
+    cursor = None
+    if timestamp_us:
+        # Microseconds are exact unlike float POSIX timestamp
+        cursor = (
+            datetime(1970, 1, 1, tzinfo=UTC)
+            + timedelta(microseconds=int(timestamp_us)),
+            int(msg_id),
+            )
+    rows = await db.get_messages(
+            room_id, direction == "before", cursor, history_page
+            )
+
+    entries = []
+    for row in rows:
+        msg_tags = {
+            "message_type": MsgType(row["message_type"].encode()),
+            "message_length": row["length"],
+            "chatroom_id": room_id,
+            "timestamp": row["timestamp"],
+        }
+        content = row["content"]
+        if msg_tags["message_type"] in FILELIKE:
+            # Files are stored as download ids of their blobs
+            msg_tags["basename"] = row["basename"] or ""
+            msg_tags["download_id"] = UUID(bytes=content)
+            msg_tags["preview"] = row["preview"] is not None
+            content = row["preview"] or b""
+        delta = row["timestamp"] - datetime(1970, 1, 1, tzinfo=UTC)
+        entries.append(HistoryEntry(
+            id=row["id"],
+            timestamp_us=delta // timedelta(microseconds=1),
+            tags=msg_tags, #type: ignore
+            data=row["sender"].encode() + b"<SEP>" + content,
+        ))
+
+    page = f"history<SEP>{direction}<SEP>".encode() + pack_history(entries)
+    reply(sender, username, tags, page)
+
+async def send_blob(
+        sender: AsyncSender, writer: StreamWriter, username: str,
+        download_id: str, *, tags: Tags
+) -> None:
+    """Starts sending content of a file-like message by its download id,
+    so commands and messages of the user are handled meanwhile."""
+    task = asyncio.create_task(
+            stream_blob(sender, username, UUID(hex=download_id), tags)
+            )
+    downloads.add(task)
+    task.add_done_callback(downloads.discard)
+
+async def stream_blob(
+        sender: AsyncSender, username: str, dl_id: UUID, tags: Tags
+) -> None:
+    """Sends blob in chunks, each one is a separate message with
+    download id, offset and total size of the blob before the data.
+    If there is no such blob or it wasn't sent to any chatroom of
+    the user only download id is sent."""
+    outbox = auth_users[username]["outbox"]
+
+    def put(data: bytes) -> None:
+        reply(sender, username, tags, b"download<SEP>" + dl_id.bytes + data)
+
+    allowed = await can_download(username, dl_id)
+    if outbox.closed:
+        return
+    if not allowed:
+        put(b"")
+        return
+    try:
+        f = open(blobs.path(dl_id), "rb")
+    except FileNotFoundError:
+        put(b"")
+        return
+
+    with f:
+        total = os.fstat(f.fileno()).st_size
+        offset = 0
+        while True:
+            await outbox.wait_for_room(download_chunk)
+            if outbox.closed:
+                return
+            chunk = await asyncio.to_thread(f.read, download_chunk)
+            put(offset.to_bytes(8, "big") + total.to_bytes(8, "big") + chunk)
+            offset += len(chunk)
+            if offset >= total or not chunk:
+                break
+
+async def start_upload(
+        sender: AsyncSender, writer: StreamWriter, username: str,
+        upload_id: str, *, tags: Tags
+) -> None:
+    """Tells client from which offset to send chunks of an upload."""
+    offset = await asyncio.to_thread(
+            blobs.upload_offset, username, UUID(hex=upload_id)
+            )
+    reply(sender, username, tags, f"upload<SEP>{upload_id}<SEP>{offset}".encode())
+
+async def receive_chunk(
+        sender: AsyncSender, username: str, payload: bytes, *, tags: Tags
+) -> None:
+    """Stores chunk of an upload. Chunk that doesn't start where the
+    stored part ends is ignored, the client learns the right
+    offset from ```start_upload``` or ```finish_upload```."""
+    upload_id, offset, data = payload.split(b"<SEP>", 2)
+    await asyncio.to_thread(
+            blobs.append, username, UUID(hex=upload_id.decode()),
+            int(offset), data
+            )
+
+async def finish_upload(
+        sender: AsyncSender, writer: StreamWriter, username: str,
+        upload_id: str, typ: str, size: str, *basename: str, tags: Tags
+) -> None:
+    """Moves complete upload into blob store and sends it to the chatroom
+    as a file-like message. If upload is incomplete the client is
+    told the offset to resume from, if its type isn't file-like
+    the client is told it failed."""
+    dl_id = UUID(hex=upload_id)
+    room_id = tags["chatroom_id"]
+    if username not in rooms.get(room_id, set()):
+        return
+    if typ.encode() not in (t.value for t in FILELIKE):
+        # Upload is kept until it expires, client stops resuming it
+        reply(sender, username, tags,
+              f"upload_failed<SEP>{upload_id}".encode())
+        return
+    try:
+        download_id = await asyncio.to_thread(
+                blobs.finish_upload, username, dl_id, int(size)
+                )
+    except (FileNotFoundError, ValueError):
+        offset = await asyncio.to_thread(blobs.upload_offset, username, dl_id)
+        reply(sender, username, tags,
+              f"upload<SEP>{upload_id}<SEP>{offset}".encode())
+        return
+
+    msg_type = MsgType(typ.encode())
+    name = "<SEP>".join(basename)
+    _, ext = os.path.splitext(name)
+    file_tags = VMediaTags(
+            message_type=msg_type,
+            message_length=int(size),
+            chatroom_id=room_id,
+            timestamp=datetime.now().astimezone(),
+            basename=name,
+            download_id=download_id,
+            preview=msg_type == MsgType.VIDEO or ext in PICTURE_EXT,
+            )
+    reply(sender, username, tags, f"uploaded<SEP>{upload_id}".encode())
+    await accept(sender, file_tags, f"{username}<SEP>".encode(), username)
+
+async def clean_uploads() -> None:
+    while True:
+        await asyncio.to_thread(blobs.remove_stale_uploads, upload_ttl)
+        await asyncio.sleep(3600)
+
 async def check_fcode(reader: StreamReader, writer: StreamWriter) -> str | None:
     while True:
         data = await reader.read(1024)
@@ -128,7 +594,7 @@ async def check_fcode(reader: StreamReader, writer: StreamWriter) -> str | None:
             break
 
         try:
-            if auth_users[friend]["friend_code"] == friend_code:
+            if get_fcode(friend) == friend_code:
                 break
         except (KeyError, ValueError):
             writer.write(b"reject")
@@ -142,42 +608,36 @@ async def sign_up(reader: StreamReader, writer: StreamWriter) -> None:
     if not friend:
         return
 
-    with Connect(passwd, db_name) as db:
-        while True:
-            data = await reader.read(2048)
-            if not data or data == b"c":
-                return
-            reg_info, aes, pub = unpack_data(data)
-            aes = s_cipher.decrypt(aes)
-            reg_info = decrypt_aes(reg_info, aes)
-            name, passw, salt, secret, device_id, pubkey = reg_info.split(b"<SEP>")
-            name = name.decode()
-            secret = secret.decode()
-            pubkey = pubkey.decode()
-
-            if name == "admin": 
-                writer.write(b"[-]")
-                continue
-            try:
-                db.get_user(name)
-                writer.write(b"[-]")
-                continue
-            except NoDataFoundError:
-                writer.write("[+] You've successfully created an account!"
-                            .encode())
-                if friend != "admin":
-                    auth_users[friend]["friend_code"] = generate_sha256()
-                else:
-                    default_code["admin"] = generate_sha256()
-                db.add_user(
-                    name,
-                    passw,
-                    salt,
-                    secret,
-                    device_id,
-                    pubkey
-                )
-                break
+    while True:
+        data = await reader.read(2048)
+        if not data or data == b"c":
+            return
+        reg_info = await crypto.open_packed(data)
+        name, passw, salt, secret, device_id, pubkey = reg_info.split(b"<SEP>")
+        name = name.decode()
+        secret = secret.decode()
+        pubkey = pubkey.decode()
+
+        if name == "admin": 
+            writer.write(b"[-]")
+            continue
+        try:
+            await db.get_user(name)
+            writer.write(b"[-]")
+            continue
+        except NoDataFoundError:
+            writer.write("[+] You've successfully created an account!"
+                        .encode())
+            await renew_fcode(friend)
+            await db.add_user(
+                name,
+                passw,
+                salt,
+                secret,
+                device_id,
+                pubkey
+            )
+            break
 
 async def secure_connect(writer: StreamWriter) -> tuple[str, int] | None:
     """Sends SSL certificate copy to a client for comparison or obtaining
@@ -210,14 +670,14 @@ async def secure_connect(writer: StreamWriter) -> tuple[str, int] | None:
         return
  
 async def check_user(writer: StreamWriter, reader: StreamReader, 
-                     username: str, d_id: bytes, cli_addr: tuple[str, int], 
-                     db: Connect) -> UserAuthInfo | None:
-    if username in auth_users:
+                     username: str, d_id: bytes, 
+                     cli_addr: tuple[str, int]) -> UserAuthInfo | None:
+    if username in auth_users or username in remote_users:
         print(f"[-] {cli_addr} tries to connect as {username}")
         writer.write("failed".encode())
         return
     try:
-        user = db.get_user(username, d_id)
+        user = await db.get_user(username, d_id)
     except NoDataFoundError:
         print(f"[-] No such user as {username}.")
         writer.write("failed".encode())
@@ -233,6 +693,12 @@ async def check_user(writer: StreamWriter, reader: StreamReader,
         # TODO: Handle lost RSA keys.
         user_pub = user[1].encode()
 
+    # Other workers are asked too, the user may be signing in there
+    if not await claim(username):
+        print(f"[-] {cli_addr} tries to connect as {username}")
+        writer.write("failed".encode())
+        return
+
     return UserAuthInfo(
         password=user[0]["password"],
         salt=user[0]["salt"],
@@ -248,58 +714,83 @@ async def handle_client(reader: StreamReader, writer: StreamWriter) -> None:
 
     writer.write(SERVER_RSA.public_key().export_key())
 
-    with Connect(passwd, db_name) as db:
-        while True:
-            data = await reader.read(1024)
-            if not data:
-                print(f"[-] {cli_addr[0]}:{cli_addr[1]} disconnected.")
-                writer.close()
-                break
-            if data == b"/signup":
-                await sign_up(reader, writer)
-                continue
-            unpacked, aes, _ = unpack_data(data)
-            aes = s_cipher.decrypt(aes)
-            name_device = decrypt_aes(unpacked, aes)
-            
-            username, device_id = name_device.split(b"<SEP>")
-            username = username.decode()
-
-            user = await check_user(writer, reader, username, 
-                                    device_id, cli_addr, db)
-            if user is None:
-                continue
+    while True:
+        data = await reader.read(1024)
+        if not data:
+            print(f"[-] {cli_addr[0]}:{cli_addr[1]} disconnected.")
+            writer.close()
+            break
+        if data == b"/signup":
+            await sign_up(reader, writer)
+            continue
+        name_device = await crypto.open_packed(data)
+
+        # Clients append the latest header version they support,
+        # older ones send only username and device id
+        username, device_id, *version = name_device.split(b"<SEP>")
+        header_version = min(int(version[0]), HEADER_VERSION) if version else 0
+        username = username.decode()
+
+        user = await check_user(writer, reader, username, 
+                                device_id, cli_addr)
+        if user is None:
+            continue
 
+        try:
             user_pub = user["user_pub"]
 
             # Challenge user
             check_bytestring = os.urandom(32)
             challenge, _ = encrypt_aes(check_bytestring, user["password"])
             challenge_string = b"<SEP>".join([user["salt"], challenge])
-            writer.write(pack_data(encrypt_aes(challenge_string), user_pub))
+            if header_version:
+                # Tells client which header version to use
+                challenge_string += f"<SEP>{header_version}".encode()
+            writer.write(await crypto.seal(challenge_string, user_pub))
             response = await reader.read(1024)
             if response != check_bytestring:
                 writer.write(b"failed")
                 print(f"[-] {username} failed to authenticate [wrong password].")
+                await release(username)
                 continue
             writer.write(b"passed")
 
             if not await verify_totp(reader, writer, user["secret"]):
                 writer.write(b"2manyA")
                 writer.close()
+                await release(username)
                 return
 
             if user["new_device"]:
-                db.add_device(username, device_id, user_pub.decode())
+                await db.add_device(username, device_id, user_pub.decode())
+            room_ids = await db.get_chatrooms(username)
 
             auth_users[username] = UserInfo(
                 sock=writer, 
                 public_key=user_pub, 
-                friend_code=generate_sha256()
+                friend_code=generate_sha256(),
+                rooms=set(),
+                header_version=header_version,
+                outbox=Outbox(
+                    writer, AsyncSender(buffer_limit),
+                    outbox_max_bytes, outbox_max_messages, slow_consumer
+                    )
                 )
+            for room_id in room_ids:
+                join_room(room_id, username)
+            if bus_client is not None:
+                await bus_client.publish({
+                    "event": "online",
+                    "user": username,
+                    "code": auth_users[username]["friend_code"],
+                })
             writer.write(b"passed")
-            asyncio.create_task(listen_for_client(reader, writer, username))
-            break
+        except BaseException:
+            await release(username)
+            raise
+        signing_in.discard(username)
+        asyncio.create_task(listen_for_client(reader, writer, username))
+        break
 
 async def verify_totp(reader: StreamReader, writer: StreamWriter, secret: str) -> bool:
     """Waits for TOTP encrypted with itself zero-padded;
@@ -325,17 +816,87 @@ async def verify_totp(reader: StreamReader, writer: StreamWriter, secret: str) -
 
 
 async def main() -> None:
+    global bus_client
+
+    # Workers are forked before database threads exist
+    crypto.start()
+
+    if workers > 1:
+        bus_client = bus.BusClient(bus_path, on_bus_event)
+        await bus_client.connect()
+
+    history_task = asyncio.create_task(history.run())
+    uploads_task = asyncio.create_task(clean_uploads())
+
     server = await asyncio.start_server(
         handle_client, SERVER_HOST, SERVER_PORT,
         family=socket.AF_INET, 
         reuse_address=True,
+        # Kernel balances connections between workers
+        reuse_port=workers > 1,
         limit=buffer_limit.value,
     )
 
     addr = server.sockets[0].getsockname()
-    print(f"[*] Listening on {addr}")
-
-    async with server:
-        await server.serve_forever()
+    print(f"[*] Listening on {addr} (pid {os.getpid()})")
 
-asyncio.run(main())
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        history_task.cancel()
+        uploads_task.cancel()
+        await history.close()
+
+def fork(target: Callable[[], None]) -> int:
+    """Runs ```target``` in a child process, returns its pid."""
+    pid = os.fork()
+    if pid == 0:
+        try:
+            target()
+        except BaseException:
+            traceback.print_exc()
+            os._exit(1)
+        os._exit(0)
+    return pid
+
+def run_worker(bus_sock: socket.socket) -> None:
+    bus_sock.close()
+    asyncio.run(main())
+
+def run_broker(bus_sock: socket.socket) -> None:
+    asyncio.run(bus.Broker(bus_sock).serve())
+
+def supervise(bus_sock: socket.socket) -> None:
+    """Runs the Broker and workers in child processes and starts a new
+    worker in place of each one that exits. Workers lose each other
+    without the Broker, so if it exits everything is started again.
+
+    Children are forked only by this process, which has no event loop
+    and no connections, so they inherit nothing but the bus socket.
+    """
+    while True:
+        broker = fork(lambda: run_broker(bus_sock))
+        children = {fork(lambda: run_worker(bus_sock)) for _ in range(workers)}
+        while True:
+            pid, status = os.wait()
+            code = os.waitstatus_to_exitcode(status)
+            if pid == broker:
+                print(f"[-] Message bus has exited with code {code}, "
+                      "restarting all workers.")
+                break
+            print(f"[-] Worker {pid} has exited with code {code}, "
+                  "restarting it.")
+            children.discard(pid)
+            children.add(fork(lambda: run_worker(bus_sock)))
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        for pid in children:
+            os.waitpid(pid, 0)
+
+if workers > 1:
+    # Bus socket is bound before forking so workers can connect at once,
+    # then this process only looks after the others
+    supervise(bus.bind(bus_path))
+else:
+    asyncio.run(main())